@@ -0,0 +1,251 @@
+# coding: utf-8
+
+# Local stand-in for a Discord webhook, for the benchmarks and for manual testing.
+#
+# It answers like Discord does: 204 (or 200 with the message when ?wait=true), 429
+# with retry_after when the rate limit of the webhook is exceeded, 413 for uploads
+# bigger than the limit, and PATCH on /messages/{id}. Every request is recorded with
+# the time it arrived and the text of its message(s).
+#
+#   python -m benchmarks.fake_discord --port 8123 --latency 0.05
+#
+# then use http://127.0.0.1:8123/api/webhooks/1/bench as the webhook URL.
+
+import argparse
+import email.parser
+import itertools
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class Request:
+    def __init__(self, arrived, method, path, size, status, contents) -> None:
+        self.arrived = arrived
+        self.method = method
+        self.path = path
+        self.size = size
+        self.status = status
+
+        # Text of every message of the request, one per embed when batched
+        self.contents = contents
+
+
+class FakeDiscord:
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        rate_limit=5,
+        rate_window=2.0,
+        upload_limit=10 * 1024 * 1024,
+        error_rate=0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.upload_limit = upload_limit
+        self.error_rate = error_rate
+
+        self.lock = threading.Lock()
+        self.requests = []
+        self.message_ids = itertools.count(1000)
+
+        # Start of the current rate-limit window, and requests counted in it
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+        fake = self
+
+        class Handler(WebhookHandler):
+            server_fake = fake
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api/webhooks/1/bench".format(
+            self.server.server_address[1]
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+    def take_token(self):
+        # Returns (remaining, reset after), remaining is -1 when rate limited
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+
+            reset_after = self.rate_window - (now - self.window_start)
+            if self.rate_limit > 0 and self.window_count >= self.rate_limit:
+                return -1, reset_after
+
+            self.window_count += 1
+            return max(0, self.rate_limit - self.window_count), reset_after
+
+    def record(self, request: Request):
+        with self.lock:
+            self.requests.append(request)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_fake: FakeDiscord = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.handle_webhook()
+
+    def do_PATCH(self):
+        self.handle_webhook()
+
+    def handle_webhook(self):
+        fake = self.server_fake
+        arrived = time.monotonic()
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        query = parse_qs(urlsplit(self.path).query)
+
+        if fake.latency > 0 or fake.jitter > 0:
+            time.sleep(fake.latency + random.uniform(0, fake.jitter))
+
+        remaining, reset_after = fake.take_token()
+        headers = {}
+        if fake.rate_limit > 0:
+            headers = {
+                "X-RateLimit-Bucket": "bench",
+                "X-RateLimit-Limit": str(fake.rate_limit),
+                "X-RateLimit-Remaining": str(max(0, remaining)),
+                "X-RateLimit-Reset-After": "{:.3f}".format(reset_after),
+            }
+
+        contents = parse_contents(self.headers.get("Content-Type", ""), body)
+
+        if remaining < 0:
+            status, answer = 429, {
+                "message": "You are being rate limited.",
+                "retry_after": round(reset_after, 3),
+                "global": False,
+            }
+        elif fake.upload_limit > 0 and length > fake.upload_limit:
+            status, answer = 413, {"message": "Request entity too large"}
+        elif fake.error_rate > 0 and random.random() < fake.error_rate:
+            status, answer = 502, {"message": "Bad gateway"}
+        elif self.command == "PATCH" or "true" in query.get("wait", []):
+            message_id = self.path.rsplit("/", 1)[-1].split("?")[0]
+            if self.command == "POST":
+                message_id = str(next(fake.message_ids))
+            status, answer = 200, {"id": message_id, "content": " ".join(contents)}
+        else:
+            status, answer = 204, None
+
+        fake.record(Request(arrived, self.command, self.path, length, status, contents))
+
+        data = json.dumps(answer).encode("utf-8") if answer is not None else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if answer is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def parse_contents(content_type, body):
+    # Text of the message(s), from a form, a multipart body or a JSON body
+    fields = {}
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        for part in message.get_payload() or []:
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+    elif content_type.startswith("application/json"):
+        fields = {"payload_json": body.decode("utf-8")}
+    else:
+        fields = {
+            name: values[0]
+            for name, values in parse_qs(body.decode("utf-8")).items()
+            if len(values) > 0
+        }
+
+    if "payload_json" in fields:
+        payload = json.loads(fields["payload_json"])
+        if len(payload.get("embeds") or []) > 0:
+            return [embed.get("description", "") for embed in payload["embeds"]]
+        return [payload.get("content", "")]
+
+    return [fields.get("content", "")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Discord webhook")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=5)
+    parser.add_argument("--rate-window", type=float, default=2.0)
+    parser.add_argument("--upload-limit", type=int, default=10 * 1024 * 1024)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeDiscord(
+        args.port,
+        args.latency,
+        args.jitter,
+        args.rate_limit,
+        args.rate_window,
+        args.upload_limit,
+        args.error_rate,
+    ).start()
+    print("Webhook URL: {}".format(fake.url))
+
+    try:
+        last = 0
+        while True:
+            time.sleep(0.5)
+            with fake.lock:
+                new = fake.requests[last:]
+                last = len(fake.requests)
+
+            for request in new:
+                print(
+                    "{} {} {} ({} bytes): {}".format(
+                        request.method,
+                        request.path,
+                        request.status,
+                        request.size,
+                        " | ".join(request.contents),
+                    )
+                )
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
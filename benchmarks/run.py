@@ -0,0 +1,454 @@
+# coding: utf-8
+
+# End-to-end benchmark of the notifications.
+#
+# Drives OctorantPlugin.on_event / on_print_progress with synthetic print jobs, against
+# the fake webhook of fake_discord.py, and reports how long each notification took to
+# reach "Discord", the throughput, the depth of the send queues and the memory used.
+#
+# Needs OctoPrint installed in the environment (e.g. the development virtualenv of the
+# plugin), run from the root of the repository:
+#
+#   python -m benchmarks.run --jobs 3 --latency 0.05
+#   python -m benchmarks.run --thumbnail --timelapse-size 20000000 --json result.json
+#
+# Nothing is sent to the real Discord.
+
+import argparse
+import base64
+import copy
+import io
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from octoprint.events import Events
+
+from octoprint_octorant import OctorantPlugin, metrics
+
+from .fake_discord import FakeDiscord
+
+# Messages of the benchmarked events, their text identifies each notification
+BENCH_EVENTS = {
+    "printing_started": "start {name}",
+    "printing_progress": "progress {name} {progress}",
+    "printing_done": "done {name}",
+    "timelapse_done": "timelapse {gcode}",
+}
+
+
+class BenchSettings:
+    # Plugin settings kept in a dict, with the same accessors as OctoPrint's
+    def __init__(self, defaults, overrides) -> None:
+        self.values = merge(copy.deepcopy(defaults), overrides)
+
+    def get(self, path, merged=False, **kwargs):
+        value = self.values
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def get_boolean(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else bool(value)
+
+    def global_get(self, path, **kwargs):
+        return None
+
+    def global_get_boolean(self, path, **kwargs):
+        return None
+
+    def set(self, path, value, **kwargs):
+        current = self.values
+        for key in path[:-1]:
+            current = current.setdefault(key, {})
+        current[path[-1]] = value
+
+    def save(self, **kwargs):
+        pass
+
+
+class BenchPrinter:
+    def __init__(self) -> None:
+        self.job = {}
+        self.progress = 0
+        self.started = 0
+
+    def is_pausing(self):
+        return False
+
+    def _payload_for_print_job_event(self):
+        return dict(self.job)
+
+    def get_current_data(self):
+        spent = time.time() - self.started
+        return {
+            "progress": {
+                "completion": self.progress,
+                "printTime": spent,
+                "printTimeLeft": spent * (100 - self.progress) / max(1, self.progress),
+            }
+        }
+
+
+class BenchFileManager:
+    def __init__(self, folder) -> None:
+        self.folder = folder
+
+    def path_on_disk(self, origin, path):
+        return os.path.join(self.folder, path)
+
+
+def merge(target, source):
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write_gcode(path, thumbnail_size):
+    # A GCode file with a PNG thumbnail in its header, like PrusaSlicer makes them
+    from PIL import Image
+
+    image = Image.frombytes(
+        "RGB",
+        (thumbnail_size, thumbnail_size),
+        bytes(
+            random.getrandbits(8) for _ in range(thumbnail_size * thumbnail_size * 3)
+        ),
+    )
+    png = io.BytesIO()
+    image.save(png, "PNG")
+    encoded = base64.b64encode(png.getvalue()).decode("ascii")
+
+    with open(path, "w") as f:
+        f.write("; generated by benchmarks/run.py\n;\n")
+        f.write("; thumbnail begin {0}x{0} {1}\n".format(thumbnail_size, len(encoded)))
+        for start in range(0, len(encoded), 78):
+            f.write("; {}\n".format(encoded[start : start + 78]))
+        f.write("; thumbnail end\n;\n")
+        for layer in range(2000):
+            f.write("G1 X{0} Y{0} Z{1:.2f} E1.0\n".format(layer % 200, layer * 0.2))
+
+
+class Sampler(threading.Thread):
+    # Samples the depth of the send queues and the memory
+    def __init__(self, plugin, interval=0.02):
+        threading.Thread.__init__(self, daemon=True)
+        self.plugin = plugin
+        self.interval = interval
+        self.depths = []
+        self.rss = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            senders = list(self.plugin.router.senders.values())
+            self.depths.append(sum(sender.queue.qsize() for sender in senders))
+            self.rss.append(rss_bytes())
+            time.sleep(self.interval)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(args):
+    folder = tempfile.mkdtemp(prefix="octorant-bench-")
+    fake = FakeDiscord(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        upload_limit=args.upload_limit,
+        error_rate=args.error_rate,
+    ).start()
+
+    events = {
+        eventID: {"enabled": True, "message": message, "media": ""}
+        for eventID, message in BENCH_EVENTS.items()
+    }
+    if args.thumbnail:
+        events["printing_started"]["media"] = "thumbnail"
+        events["printing_progress"]["media"] = "thumbnail"
+    if args.timelapse_size > 0:
+        events["timelapse_done"]["media"] = "timelapse"
+
+    plugin = OctorantPlugin()
+    plugin._identifier = "octorant"
+    plugin._logger = logging.getLogger("octoprint.plugins.octorant")
+    plugin._data_folder = os.path.join(folder, "data")
+    plugin._printer = BenchPrinter()
+    plugin._file_manager = BenchFileManager(folder)
+    plugin._settings = BenchSettings(
+        plugin.get_settings_defaults(),
+        {
+            "url": fake.url,
+            "events": events,
+            "progress": {
+                "percentage_enabled": True,
+                "percentage_step": args.progress_step,
+                "edit_in_place": args.edit_in_place,
+            },
+            "batch": {"window": args.batch_window},
+            "http": {"engine": args.engine},
+            "media": {"upload_limit": args.upload_limit},
+            "timelapse": {"transcode": False},
+        },
+    )
+
+    rss_start = rss_bytes()
+    plugin.initialize()
+
+    sampler = Sampler(plugin)
+    sampler.start()
+
+    # notification text -> time the event was fired
+    sent = {}
+
+    # Notifications the plugin decided to send
+    notified = []
+    started = time.monotonic()
+
+    # Time spent in the handlers called by OctoPrint
+    handler_times = []
+
+    def call(handler, *args):
+        called = time.monotonic()
+        handler(*args)
+        handler_times.append(time.monotonic() - called)
+
+    for job in range(args.jobs):
+        name = "job-{}".format(job)
+        path = name + ".gcode"
+        if args.thumbnail:
+            write_gcode(os.path.join(folder, path), args.thumbnail_size)
+            # What FILE_ADDED does, which needs OctoPrint's plugin manager to
+            # recognize GCode files
+            plugin.thumbnails.warm(os.path.join(folder, path))
+
+        payload = {
+            "name": name,
+            "path": path,
+            "origin": "local",
+            "size": 0,
+            "owner": "bench",
+            "user": "bench",
+        }
+        plugin._printer.job = payload
+        plugin._printer.started = time.time()
+
+        sent["start " + name] = time.monotonic()
+        notified.append("start " + name)
+        call(plugin.on_event, Events.PRINT_STARTED, dict(payload))
+
+        for progress in range(1, 101):
+            plugin._printer.progress = progress
+            content = "progress {} {}".format(name, progress)
+            sent[content] = time.monotonic()
+
+            last = plugin.lastProgressPercent
+            call(plugin.on_print_progress, "local", path, progress)
+            # Whether it is notified is only known once the dispatcher handled it
+            plugin.eventQueue.join()
+            if plugin.lastProgressPercent != last:
+                notified.append(content)
+            time.sleep(args.tick)
+
+        sent["done " + name] = time.monotonic()
+        notified.append("done " + name)
+        call(plugin.on_event, Events.PRINT_DONE, dict(payload, time=100 * args.tick))
+
+        if args.timelapse_size > 0:
+            movie = os.path.join(folder, name + ".mp4")
+            with open(movie, "wb") as f:
+                f.truncate(args.timelapse_size)
+
+            sent["timelapse " + name] = time.monotonic()
+            notified.append("timelapse " + name)
+            call(
+                plugin.on_event,
+                Events.MOVIE_DONE,
+                {
+                    "gcode": name,
+                    "movie": movie,
+                    "movie_basename": name + ".mp4",
+                    "movie_prefix": name,
+                },
+            )
+
+    fired = time.monotonic() - started
+
+    # Wait for everything to be sent, including the messages postponed in the outbox
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        if plugin.eventQueue.unfinished_tasks > 0:
+            time.sleep(0.05)
+            continue
+
+        senders = list(plugin.router.senders.values())
+        if all(sender.queue.unfinished == 0 for sender in senders) and all(
+            sender.outbox is None or sender.outbox.next_due() is None
+            for sender in senders
+        ):
+            break
+        time.sleep(0.05)
+
+    # Still waiting for a new attempt at the end of the drain timeout
+    outbox_pending = sum(
+        sender.outbox.size()
+        for sender in plugin.router.senders.values()
+        if sender.outbox is not None
+    )
+
+    elapsed = time.monotonic() - started
+    sampler.running = False
+    sampler.join()
+    fake.stop()
+
+    latencies = []
+    delivered = set()
+    statuses = {}
+    for request in fake.requests:
+        statuses[request.status] = statuses.get(request.status, 0) + 1
+        if request.status >= 300:
+            continue
+
+        for content in request.contents:
+            if content in sent and content not in delivered:
+                delivered.add(content)
+                latencies.append(request.arrived - sent[content])
+
+    result = {
+        "jobs": args.jobs,
+        "engine": plugin.router.engine,
+        "events_fired_in_s": round(fired, 3),
+        "elapsed_s": round(elapsed, 3),
+        "notifications_expected": len(notified),
+        "notifications_delivered": len(delivered),
+        # Progress replaced in the queue by a newer one, that's expected under load
+        "progress_superseded": len(
+            [c for c in notified if c.startswith("progress ") and c not in delivered]
+        ),
+        # Not delivered yet, see --drain-timeout
+        "outbox_pending": outbox_pending,
+        # Anything else missing is a bug
+        "notifications_lost": len(
+            [
+                c
+                for c in notified
+                if not c.startswith("progress ") and c not in delivered
+            ]
+        ),
+        "requests": len(fake.requests),
+        "requests_by_status": {str(k): v for k, v in sorted(statuses.items())},
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(max(latencies, default=0) * 1000, 1),
+            "mean": round(statistics.mean(latencies) * 1000, 1) if latencies else 0,
+        },
+        "handler_us": {
+            "max": round(max(handler_times, default=0) * 1e6, 1),
+            "mean": (
+                round(statistics.mean(handler_times) * 1e6, 1) if handler_times else 0
+            ),
+        },
+        "throughput_per_s": round(len(delivered) / elapsed, 2) if elapsed else 0,
+        "queue_depth": {
+            "max": max(sampler.depths, default=0),
+            "mean": round(statistics.mean(sampler.depths), 2) if sampler.depths else 0,
+        },
+        "rss_mb": {
+            "start": round(rss_start / 1e6, 1),
+            "end": round(rss_bytes() / 1e6, 1),
+            "max_sampled": round(max(sampler.rss, default=0) / 1e6, 1),
+            "peak": round(peak_rss_bytes() / 1e6, 1),
+        },
+        # The settings are read again only when they are saved
+        "settings_snapshots": sum(metrics.settings_snapshots.values.values()),
+    }
+
+    shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OctoRant end-to-end benchmark")
+    parser.add_argument("--jobs", type=int, default=3, help="number of prints")
+    parser.add_argument(
+        "--tick", type=float, default=0.01, help="seconds between progress steps"
+    )
+    parser.add_argument("--progress-step", type=int, default=10)
+    parser.add_argument("--thumbnail", action="store_true", help="send thumbnails")
+    parser.add_argument("--thumbnail-size", type=int, default=300)
+    parser.add_argument(
+        "--timelapse-size", type=int, default=0, help="bytes, 0 for no timelapse"
+    )
+    parser.add_argument("--edit-in-place", action="store_true")
+    parser.add_argument("--batch-window", type=float, default=0)
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--rate-limit", type=int, default=5)
+    parser.add_argument("--rate-window", type=float, default=2.0)
+    parser.add_argument("--upload-limit", type=int, default=10 * 1024 * 1024)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s %(threadName)s %(levelname)s %(message)s",
+    )
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
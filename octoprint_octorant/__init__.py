@@ -1,53 +1,198 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import octoprint.filemanager
 import octoprint.plugin
 import octoprint.settings
 import octoprint.util
 import subprocess
 import datetime
+import threading
 import time
 import os
+import queue
+import flask
+
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from octoprint.events import Events, eventManager
 from octoprint.util import RepeatedTimer
 from octoprint.util.version import is_octoprint_compatible
 
-from .discord import DiscordMessage
+from . import metrics
+from .config import Config
 from .events import EVENTS
-from .media import Media
+from .media import Media, ThumbnailCache
+from .outqueue import DEFAULT_PRIORITY
+from .router import Router
+from .tracing import Trace, Tracer
+
+# Variables of the progress messages, computed only when the message uses them
+PRINT_JOB_VARIABLES = ["name", "path", "origin", "size", "owner", "user"]
+PROGRESS_VARIABLES = [
+    "progress",
+    "remaining",
+    "spent",
+    "remaining_formatted",
+    "spent_formatted",
+]
 
 
 class OctorantPlugin(
     octoprint.plugin.StartupPlugin,
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.ProgressPlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
+    octoprint.plugin.BlueprintPlugin,
 ):
     def __init__(self):
         self.events = EVENTS
         self.uploading = False
 
         # progress specific variables
-        self.progressTimer = None
+        self.progressLock = threading.Lock()
+        self.progressActive = False
+        self.progressTimer: threading.Timer = None
+        self.transferTimer: RepeatedTimer = None
         self.lastProgressNotifiedAt = 0
         self.lastProgressPercent = 0
         self.lastProgressTime = 0
         self.lastProgressHeight = 0
 
-        # Discord webhook handler
-        self.discord: DiscordMessage = None
+        # Discord webhooks handler
+        self.router: Router = None
+
+        # GCode thumbnails, extracted once per file
+        self.thumbnails: ThumbnailCache = None
+
+        # Timing of the latest notifications
+        self.tracer: Tracer = None
+
+        # OctoPrint events, handled in order by the dispatcher thread
+        self.eventQueue = queue.Queue()
+        self.dispatcher: threading.Thread = None
+
+        # Before/after scripts, one at a time and in order, away from the event thread
+        self.scriptPool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="octorant-scripts"
+        )
+
+        # Settings snapshot, replaced on every save
+        self.config: Config = None
 
     def initialize(self):
+        self.load_config()
+
+        self.tracer = Tracer(self._logger)
+        self.configure_tracing()
+
         # Instantiate Discord handler
-        self.discord = DiscordMessage(self._logger)
-        self.discord.set_config(
-            self._settings.get(["url"], merged=True),
-            self._settings.get(["username"], merged=True),
-            self._settings.get(["avatar"], merged=True),
+        # The engine is only chosen at startup
+        self.router = Router(self._logger, self.config.http_engine)
+        self.router.apply_config(self.config)
+        self.configure_outbox()
+
+        self.thumbnails = ThumbnailCache(self._logger)
+        self.configure_thumbnails()
+
+        self.register_metrics()
+
+        self.dispatcher = threading.Thread(
+            target=self.dispatch_events, name="octorant-events", daemon=True
+        )
+        self.dispatcher.start()
+
+    def register_metrics(self):
+        # Read when the metrics are scraped
+        metrics.registry.gauge(
+            "octorant_queue_depth",
+            "Messages waiting in the send queue",
+            lambda: {
+                (("webhook", name),): sender.queue.qsize()
+                for name, sender in list(self.router.senders.items())
+            },
+        )
+
+    def load_config(self):
+        # Settings are read once here, and the new snapshot replaces the old one at once
+        if self.config is not None:
+            self._logger.debug("Reloading settings")
+
+        self.config = Config.from_settings(self._settings)
+        metrics.settings_snapshots.inc(reason="plugin")
+
+        # Report the problems in the messages now rather than when they are sent
+        for eventID, template in self.config.templates.items():
+            if template.error is not None:
+                self._logger.warning(
+                    "Message for event {} is invalid: {}".format(
+                        eventID, template.error
+                    )
+                )
+
+            unknown = template.unknown(
+                self.config.events[eventID].get("variables") or []
+            )
+            if len(unknown) > 0:
+                self._logger.warning(
+                    "Message for event {} uses unknown variables: {}".format(
+                        eventID, ", ".join(unknown)
+                    )
+                )
+
+            for webhook in self.config.events[eventID].get("webhooks") or []:
+                if webhook not in self.config.webhooks:
+                    self._logger.warning(
+                        "Event {} is sent to unknown webhook {}".format(
+                            eventID, webhook
+                        )
+                    )
+
+    def configure_thumbnails(self):
+        config = self.config
+
+        folder = None
+        if config.thumbnails_disk_cache:
+            folder = os.path.join(self.get_plugin_data_folder(), "thumbnails")
+
+        self.thumbnails.set_config(config.thumbnails_cache_size, folder)
+        self.thumbnails.set_scan_config(
+            config.thumbnails_header_budget,
+            config.thumbnails_tail_budget,
+            config.thumbnails_use_mmap,
+        )
+        self.thumbnails.set_output_config(
+            config.thumbnails_target_width,
+            config.thumbnails_target_height,
+            config.thumbnails_encode,
+            config.thumbnails_quality,
+        )
+
+    def configure_outbox(self):
+        config = self.config
+
+        folder = None
+        if config.outbox_enabled:
+            folder = self.get_plugin_data_folder()
+
+        self.router.set_outbox(
+            folder,
+            config.outbox_base_delay,
+            config.outbox_max_delay,
+            config.outbox_max_attempts,
         )
 
+    def configure_tracing(self):
+        config = self.config
+
+        path = None
+        if config.tracing_export:
+            path = os.path.join(self.get_plugin_data_folder(), "traces.jsonl")
+
+        self.tracer.set_config(config.tracing_buffer_size, path)
+
     def on_after_startup(self):
         self._logger.info("OctoRant is started!")
 
@@ -62,6 +207,7 @@ class OctorantPlugin(
             "allow_scripts": False,
             "script_before": "",
             "script_after": "",
+            "script_timeout": 30,
             "progress": {
                 "percentage_enabled": True,
                 "percentage_step": 10,
@@ -71,19 +217,73 @@ class OctorantPlugin(
                 "height_step": 0,
                 "throttle_enabled": False,
                 "throttle_step": 0,
+                "edit_in_place": False,
+            },
+            "http": {
+                "engine": "thread",
+                "pool_size": 2,
+                "idle_timeout": 60,
+            },
+            "media": {
+                "workers": 2,
+                "timeout": 30,
+                "upload_limit": 10 * 1024 * 1024,
+            },
+            "queue": {
+                "capacity": 100,
+                "aging": 30,
+            },
+            "batch": {
+                "window": 0,
+            },
+            "webhooks": {},
+            "outbox": {
+                "enabled": True,
+                "base_delay": 5,
+                "max_delay": 900,
+                "max_attempts": 10,
+            },
+            "thumbnails": {
+                "cache_size": 16,
+                "disk_cache": True,
+                "header_budget": 4 * 1024 * 1024,
+                "tail_budget": 1024 * 1024,
+                "use_mmap": False,
+                "target_width": 0,
+                "target_height": 0,
+                "encode": "",
+                "quality": 85,
+            },
+            "timelapse": {
+                "transcode": True,
+                "transcode_timeout": 600,
+                "min_bitrate": 200000,
+                "fallback": "clip",
+            },
+            "tracing": {
+                "buffer_size": 50,
+                "export": False,
+            },
+            "snapshot": {
+                "max_width": 0,
+                "max_height": 0,
+                "quality": 75,
+                "lossless_transform": True,
+                "cache_ttl": 2,
             },
         }
 
     # Restricts some paths to some roles only
     def get_settings_restricted_paths(self):
         # settings.events.tests is a false message, so we should never see it as configurable.
-        # settings.url, username and avatar are admin only.
+        # settings.url, username, avatar and webhooks are admin only.
         return dict(
             never=[["events", "test"]],
             admin=[
                 ["url"],
                 ["username"],
                 ["avatar"],
+                ["webhooks"],
                 ["script_before"],
                 ["script_after"],
             ],
@@ -91,29 +291,21 @@ class OctorantPlugin(
 
     # Overrides
     def on_settings_save(self, data):
-        old_bot_settings = "{}{}{}".format(
-            self._settings.get(["url"], merged=True),
-            self._settings.get(["avatar"], merged=True),
-            self._settings.get(["username"], merged=True),
-        )
+        old_config = self.config
 
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 
-        new_bot_settings = "{}{}{}".format(
-            self._settings.get(["url"], merged=True),
-            self._settings.get(["avatar"], merged=True),
-            self._settings.get(["username"], merged=True),
-        )
+        self.load_config()
+        self.router.apply_config(self.config)
+        self.configure_outbox()
+        self.configure_thumbnails()
+        self.configure_tracing()
+
+        old_bot_settings = old_config.webhooks
+        new_bot_settings = self.config.webhooks
 
         if old_bot_settings != new_bot_settings:
             self._logger.info("Settings have changed. Send a test message...")
-
-            self.discord.set_config(
-                self._settings.get(["url"], merged=True),
-                self._settings.get(["username"], merged=True),
-                self._settings.get(["avatar"], merged=True),
-            )
-
             self.notify_event("test")
 
     def get_settings_version(self):
@@ -158,6 +350,21 @@ class OctorantPlugin(
     def get_template_configs(self):
         return [dict(type="settings", custom_bindings=True)]
 
+    ##~~ BlueprintPlugin mixin
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.Response(
+            metrics.registry.render(), mimetype="text/plain; version=0.0.4"
+        )
+
+    @octoprint.plugin.BlueprintPlugin.route("/traces", methods=["GET"])
+    def get_traces(self):
+        return flask.jsonify(traces=self.tracer.recent())
+
+    def is_blueprint_csrf_protected(self):
+        return True
+
     ##~~ Softwareupdate hook
 
     def get_update_information(self):
@@ -183,15 +390,48 @@ class OctorantPlugin(
 
     ##~~ EventHandlerPlugin hook
     def on_event(self, event: str, payload):
+        started = time.monotonic()
+
         # Let's avoid dealing with our own events...
         if event.startswith("plugin_octorant"):
             return
 
+        # OctoPrint calls the handlers of every plugin one after the other, the
+        # work is done by the dispatcher thread. The payload is copied, as the
+        # notifications add their own variables to it.
+        self.enqueue_event(
+            event, self.handle_event, event, None if payload is None else dict(payload)
+        )
+        metrics.on_event_duration.observe(time.monotonic() - started)
+
+    def enqueue_event(self, source, handler, *args):
+        self.eventQueue.put((source, time.monotonic(), handler, args))
+
+    def dispatch_events(self):
+        while True:
+            source, queued_at, handler, args = self.eventQueue.get()
+            metrics.event_queue_wait.observe(time.monotonic() - queued_at)
+
+            try:
+                # The notifications of the event share its correlation id
+                with self.tracer.event(source, queued_at):
+                    handler(*args)
+            except Exception:
+                self._logger.exception("Unable to handle event {}".format(source))
+            finally:
+                self.eventQueue.task_done()
+
+    def handle_event(self, event: str, payload):
         # System
         if event == Events.STARTUP:
             return self.notify_event("startup")
         if event == Events.SHUTDOWN:
             return self.notify_event("shutdown")
+        if event == Events.SETTINGS_UPDATED:
+            # e.g. the webcam settings of OctoPrint, used for the snapshots
+            self.config = self.config.with_core_settings(self._settings)
+            metrics.settings_snapshots.inc(reason="octoprint")
+            return
 
         # Printer
         if event == Events.PRINTER_STATE_CHANGED:
@@ -223,9 +463,6 @@ class OctorantPlugin(
             return self.notify_event("printing_cancelled", payload)
         if event == Events.PRINT_DONE:
             self.stop_progress_check()
-            payload["time_formatted"] = str(
-                datetime.timedelta(seconds=int(payload["time"]))
-            )
             return self.notify_event("printing_done", payload)
 
         # SD Card transfer
@@ -234,9 +471,6 @@ class OctorantPlugin(
             self.start_progress_check()
             return self.notify_event("transfer_started", payload)
         if event == Events.TRANSFER_DONE:
-            payload["time_formatted"] = str(
-                datetime.timedelta(seconds=int(payload["time"]))
-            )
             self.uploading = False
             self.stop_progress_check()
             self.notify_event("transfer_done", payload)
@@ -247,6 +481,32 @@ class OctorantPlugin(
             self.notify_event("transfer_failed", payload)
             return True
 
+        # Files: extract the thumbnail now, so that notifications don't have to
+        if event in [Events.UPLOAD, Events.FILE_ADDED]:
+            storage = payload.get("storage", payload.get("target"))
+            if (
+                self.config.thumbnails_used
+                and storage == "local"
+                and octoprint.filemanager.valid_file_type(
+                    payload.get("path", ""), type="gcode"
+                )
+            ):
+                self.thumbnails.warm(
+                    self._file_manager.path_on_disk(storage, payload["path"])
+                )
+            return True
+        if event in [Events.FILE_REMOVED, Events.FILE_MOVED]:
+            storage = payload.get("storage", payload.get("source_storage"))
+            path = payload.get("path", payload.get("source_path"))
+            if storage == "local" and path:
+                self.thumbnails.forget(self._file_manager.path_on_disk(storage, path))
+            return True
+
+        # Height progress
+        if event == Events.Z_CHANGE:
+            self.progress_check("height", payload.get("new"))
+            return True
+
         # Timelapses
         if event == Events.MOVIE_DONE:
             return self.notify_event("timelapse_done", payload)
@@ -259,190 +519,245 @@ class OctorantPlugin(
 
     def start_progress_check(self):
         # If already set, we must stop it
-        if self.progressTimer is not None:
-            self.stop_progress_check()
+        self.stop_progress_check()
 
-        # Reset all variables
-        self.lastProgressNotifiedAt = 0
-        self.lastProgressPercent = 0
-        self.lastProgressTime = 0
-        self.lastProgressHeight = 0
+        with self.progressLock:
+            # Reset all variables
+            self.lastProgressNotifiedAt = 0
+            self.lastProgressPercent = 0
+            self.lastProgressTime = 0
+            self.lastProgressHeight = 0
+            self.progressActive = True
+
+        # Prints report their progress through on_print_progress and Z changes,
+        # SD transfers don't so we still have to poll the printer for them.
+        if self.uploading:
+            self.transferTimer = RepeatedTimer(0.5, self.poll_transfer_progress)
+            self.transferTimer.start()
 
-        # Start the thread
-        self.progressTimer = RepeatedTimer(0.5, self.progress_check)
-        self.progressTimer.start()
+        # Only the timed interval needs a timer
+        self.schedule_progress_timer()
 
     def stop_progress_check(self):
-        if self.progressTimer is not None:
-            self.progressTimer.cancel()
-            self.progressTimer = None
+        with self.progressLock:
+            self.progressActive = False
 
-    def progress_check(self):
-        notifyReason = ""
+            if self.progressTimer is not None:
+                self.progressTimer.cancel()
+                self.progressTimer = None
 
-        # First we check the throttle and return if we are too early
-        if (
-            self._settings.get_boolean(["progress", "throttle_enabled"], merged=True)
-            == True
-        ):
-            if time.time() < (
-                self.lastProgressNotifiedAt
-                + self._settings.get_int(["progress", "throttle_step"], merged=True)
-            ):
-                return
+            if self.transferTimer is not None:
+                self.transferTimer.cancel()
+                self.transferTimer = None
 
-        # Get the printer data
-        printer_data = self._printer.get_current_data()
+    def schedule_progress_timer(self, rearm=False):
+        config = self.config
 
-        # don't do anything if the printer is paused
-        if self._printer.is_pausing():
-            return
+        with self.progressLock:
+            if self.progressTimer is not None:
+                self.progressTimer.cancel()
+                self.progressTimer = None
 
-        # Time check.
-        if (
-            notifyReason == ""
-            and self._settings.get_boolean(["progress", "time_enabled"], merged=True)
-            == True
-        ):
-            if time.time() > (
-                self.lastProgressTime
-                + self._settings.get_int(["progress", "time_step"], merged=True)
-            ):
-                self._logger.debug(
-                    "Progress Check: Timer threshold was hit (last: {}, current: {})".format(
-                        self.lastProgressTime, time.time()
-                    )
-                )
-                self.lastProgressTime = time.time()
-                notifyReason = "time"
-            else:
-                self._logger.debug(
-                    "Progress Check: Timer not triggerd (last: {}, current: {})".format(
-                        self.lastProgressTime, time.time()
-                    )
+            if not self.progressActive:
+                return
+
+            if not config.progress_time_enabled:
+                return
+
+            # Sleep until the next notification is due, never less than a second
+            deadline = self.lastProgressTime + max(1, config.progress_time_step)
+            if config.progress_throttle_enabled:
+                deadline = max(
+                    deadline,
+                    self.lastProgressNotifiedAt + config.progress_throttle_step,
                 )
 
-        # Percentage check
+            delay = deadline - time.time()
+            if rearm and delay <= 0:
+                # The check returned early (e.g. the printer is pausing), the deadline
+                # didn't move: wait a full step rather than spinning
+                delay = max(1, config.progress_time_step)
+
+            self.progressTimer = threading.Timer(max(0, delay), self.on_progress_timer)
+            self.progressTimer.daemon = True
+            self.progressTimer.start()
+
+    def on_progress_timer(self):
+        # Handled by the dispatcher, in order with the print events
+        self.enqueue_event("ProgressTimer", self.handle_progress_timer)
+
+    def handle_progress_timer(self):
+        self.progress_check("time")
+        self.schedule_progress_timer(rearm=True)
+
+    def poll_transfer_progress(self):
+        self.enqueue_event("TransferProgress", self.handle_transfer_progress)
+
+    def handle_transfer_progress(self):
+        printer_data = self._printer.get_current_data()
         if (
-            notifyReason == ""
-            and self._settings.get_boolean(
-                ["progress", "percentage_enabled"], merged=True
-            )
-            == True
+            printer_data["progress"] is not None
+            and printer_data["progress"]["completion"] is not None
         ):
-            if int(printer_data["progress"]["completion"]) > 0:
-                if int(printer_data["progress"]["completion"]) > (
-                    self.lastProgressPercent
-                    + self._settings.get_int(
-                        ["progress", "percentage_step"], merged=True
-                    )
+            self.progress_check("percentage", printer_data["progress"]["completion"])
+
+    ##~~ ProgressPlugin mixin
+    def on_print_progress(self, storage, path, progress):
+        started = time.monotonic()
+
+        # Queued with the events, to be handled after the print started
+        self.enqueue_event("PrintProgress", self.handle_print_progress, progress)
+        metrics.on_event_duration.observe(time.monotonic() - started)
+
+    def handle_print_progress(self, progress):
+        if not self.uploading:
+            self.progress_check("percentage", progress)
+
+    def progress_check(self, trigger, value=None):
+        config = self.config
+        notifyReason = ""
+
+        with self.progressLock:
+            if not self.progressActive:
+                return
+
+            # First we check the throttle and return if we are too early
+            if config.progress_throttle_enabled:
+                if time.time() < (
+                    self.lastProgressNotifiedAt + config.progress_throttle_step
                 ):
+                    return
+
+            # don't do anything if the printer is paused
+            if self._printer.is_pausing():
+                return
+
+            # Time check.
+            if trigger == "time" and config.progress_time_enabled:
+                if time.time() >= (self.lastProgressTime + config.progress_time_step):
                     self._logger.debug(
-                        "Progress Check: Percentage threshold was hit (last: {}, current: {})".format(
-                            self.lastProgressPercent,
-                            int(printer_data["progress"]["completion"]),
+                        "Progress Check: Timer threshold was hit (last: {}, current: {})".format(
+                            self.lastProgressTime, time.time()
                         )
                     )
-                    self.lastProgressPercent = int(
-                        printer_data["progress"]["completion"]
-                    )
-                    notifyReason = "percentage"
+                    self.lastProgressTime = time.time()
+                    notifyReason = "time"
                 else:
                     self._logger.debug(
-                        "Progress Check: Percentage not triggerd (last: {}, current: {})".format(
-                            self.lastProgressPercent,
-                            int(printer_data["progress"]["completion"]),
+                        "Progress Check: Timer not triggerd (last: {}, current: {})".format(
+                            self.lastProgressTime, time.time()
                         )
                     )
 
-        # Height check
-        if (
-            notifyReason == ""
-            and self._settings.get_boolean(["progress", "height_enabled"], merged=True)
-            == True
-        ):
-            if printer_data["currentZ"] is not None:
-                # let's check for abnormal Z moves and discard them.
-                # basic test if the current Z is larger than 5 times the step configured, that means a strange move that we'll discard.
-                if float(printer_data["currentZ"]) > 0 and float(
-                    printer_data["currentZ"]
-                ) > (
-                    self.lastProgressHeight
-                    + (
-                        self._settings.get_float(
-                            ["progress", "height_step"], merged=True
+            # Percentage check
+            if trigger == "percentage" and config.progress_percentage_enabled:
+                if int(value) > 0:
+                    if int(value) > (
+                        self.lastProgressPercent + config.progress_percentage_step
+                    ):
+                        self._logger.debug(
+                            "Progress Check: Percentage threshold was hit (last: {}, current: {})".format(
+                                self.lastProgressPercent, int(value)
+                            )
+                        )
+                        self.lastProgressPercent = int(value)
+                        notifyReason = "percentage"
+                    else:
+                        self._logger.debug(
+                            "Progress Check: Percentage not triggerd (last: {}, current: {})".format(
+                                self.lastProgressPercent, int(value)
+                            )
                         )
-                        * 5
-                    )
-                ):
-                    return
 
-                if float(printer_data["currentZ"]) > 0 and float(
-                    printer_data["currentZ"]
-                ) > (
-                    self.lastProgressHeight
-                    + self._settings.get_float(["progress", "height_step"], merged=True)
-                ):
-                    self._logger.debug(
-                        "Progress Check: Height threshold was hit (last: {}, current: {})".format(
-                            self.lastProgressHeight, float(printer_data["currentZ"])
+            # Height check
+            if trigger == "height" and config.progress_height_enabled:
+                if value is not None:
+                    # let's check for abnormal Z moves and discard them.
+                    # basic test if the current Z is larger than 5 times the step configured, that means a strange move that we'll discard.
+                    if float(value) > 0 and float(value) > (
+                        self.lastProgressHeight + (config.progress_height_step * 5)
+                    ):
+                        return
+
+                    if float(value) > 0 and float(value) > (
+                        self.lastProgressHeight + config.progress_height_step
+                    ):
+                        self._logger.debug(
+                            "Progress Check: Height threshold was hit (last: {}, current: {})".format(
+                                self.lastProgressHeight, float(value)
+                            )
                         )
-                    )
-                    self.lastProgressHeight = float(printer_data["currentZ"])
-                    notifyReason = "height"
+                        self.lastProgressHeight = float(value)
+                        notifyReason = "height"
 
-                else:
-                    self._logger.debug(
-                        "Progress Check: Height not triggerd (last: {}, current: {})".format(
-                            self.lastProgressHeight, float(printer_data["currentZ"])
+                    else:
+                        self._logger.debug(
+                            "Progress Check: Height not triggerd (last: {}, current: {})".format(
+                                self.lastProgressHeight, float(value)
+                            )
                         )
-                    )
+
+            if notifyReason != "":
+                self.lastProgressNotifiedAt = time.time()
 
         # Alright let's notify if necessary
         if notifyReason != "":
-            self.lastProgressNotifiedAt = time.time()
-            payload = {}
-            payload["reason"] = notifyReason
+            self.notify_progress(notifyReason)
 
-            if self.uploading == False:
+    def notify_progress(self, notifyReason):
+        eventID = "printing_progress" if not self.uploading else "transfer_progress"
+        event_configuration = self.config.events[eventID]
+        template = self.config.templates[eventID]
+
+        payload = {}
+
+        # Only ask the printer for what the message really needs
+        if self.uploading == False and event_configuration["enabled"] == True:
+            if template.uses(*PRINT_JOB_VARIABLES) or (
+                event_configuration["media"] == "thumbnail"
+            ):
                 payload = self._printer._payload_for_print_job_event()
 
-                payload["reason"] = notifyReason
-                payload["progress"] = 0
-                payload["remaining"] = 0
-                payload["remaining_formatted"] = "0s"
-                payload["spent"] = 0
-                payload["spent_formatted"] = "0s"
+            payload["progress"] = 0
+            payload["remaining"] = 0
+            payload["spent"] = 0
+
+            if template.uses(*PROGRESS_VARIABLES):
+                # Get the printer data
+                printer_data = self._printer.get_current_data()
 
                 if printer_data["progress"] is not None:
                     if printer_data["progress"]["printTimeLeft"] is not None:
                         payload["remaining"] = int(
                             printer_data["progress"]["printTimeLeft"]
                         )
-                        payload["remaining_formatted"] = str(
-                            datetime.timedelta(seconds=payload["remaining"])
-                        )
                     if printer_data["progress"]["printTime"] is not None:
                         payload["spent"] = int(printer_data["progress"]["printTime"])
-                        payload["spent_formatted"] = str(
-                            datetime.timedelta(seconds=payload["spent"])
-                        )
                     if printer_data["progress"]["completion"] is not None:
                         payload["progress"] = int(
                             printer_data["progress"]["completion"]
                         )
 
-            self.notify_event(
-                "printing_progress" if not self.uploading else "transfer_progress",
-                payload,
-            )
+            if template.uses("remaining_formatted"):
+                payload["remaining_formatted"] = str(
+                    datetime.timedelta(seconds=payload["remaining"])
+                )
+            if template.uses("spent_formatted"):
+                payload["spent_formatted"] = str(
+                    datetime.timedelta(seconds=payload["spent"])
+                )
+
+        payload["reason"] = notifyReason
+
+        self.notify_event(eventID, payload)
 
     def notify_event(self, eventID, data={}):
         if eventID not in self.events:
             self._logger.error("Tried to notifiy on inexistant eventID : ", eventID)
             return False
 
-        event_configuration = self._settings.get(["events", eventID], merged=True)
+        config = self.config
+        event_configuration = config.events[eventID]
 
         if event_configuration["enabled"] != True:
             self._logger.debug(
@@ -450,66 +765,102 @@ class OctorantPlugin(
             )
             return False
 
+        metrics.events.inc(event=eventID)
+
+        trace = self.tracer.start(eventID)
+        try:
+            return self.prepare_message(eventID, data, trace)
+        finally:
+            trace.release()
+
+    def prepare_message(self, eventID, data, trace):
+        config = self.config
+        event_configuration = config.events[eventID]
+        template = config.templates[eventID]
+
         # Alter a bit the payload to offer more variables
-        if "time" in data:
+        if "time" in data and template.uses("time_formatted"):
             data["time_formatted"] = str(datetime.timedelta(seconds=int(data["time"])))
 
         self._logger.debug(
             "Available variables for event " + eventID + ": " + ", ".join(list(data))
         )
-        try:
-            message = event_configuration["message"].format(**data)
-        except KeyError as error:
-            # Detected some tags that are not found in the payload
-            message = (
-                event_configuration["message"]
-                + """\r\n:sos: **OctoRant Error**: unknown variable `{"""
-                + error.args[0]
-                + """}`."""
-            )
-        finally:
-            # Let's get some media
-            media = Media(self._settings, self._logger)
+        with trace.span("render"):
+            message = template.render(data)
 
-            if event_configuration["media"] != "":
-                if event_configuration["media"] == "thumbnail":
-                    media.set_thumbnail(
-                        self._file_manager.path_on_disk(data["origin"], data["path"])
+        # Let's get some media
+        media = Media(config, self._logger)
+
+        if event_configuration["media"] != "":
+            if event_configuration["media"] == "thumbnail":
+                media.set_thumbnail(
+                    self._file_manager.path_on_disk(data["origin"], data["path"]),
+                    self.thumbnails,
+                )
+            elif event_configuration["media"] == "snapshot":
+                if is_octoprint_compatible(">=1.9"):
+                    media.set_snapshot()
+                else:
+                    media.set_snapshot(
+                        url=config.webcam_snapshot_url,
+                        mustFlipH=config.webcam_flipH,
+                        mustFlipV=config.webcam_flipV,
+                        mustRotate=config.webcam_rotate90,
                     )
-                elif event_configuration["media"] == "snapshot":
-                    if is_octoprint_compatible(">=1.9"):
-                        media.set_snapshot()
-                    else:
-                        media.set_snapshot(
-                            url=self._settings.global_get(["webcam", "snapshot"]),
-                            mustFlipH=self._settings.global_get_boolean(
-                                ["webcam", "flipH"]
-                            ),
-                            mustFlipV=self._settings.global_get_boolean(
-                                ["webcam", "flipV"]
-                            ),
-                            mustRotate=self._settings.global_get_boolean(
-                                ["webcam", "rotate90"]
-                            ),
-                        )
-                elif event_configuration["media"] == "timelapse":
-                    media.set_timelapse(filePath=data["movie"])
+            elif event_configuration["media"] == "timelapse":
+                media.set_timelapse(
+                    filePath=data["movie"],
+                    maxAcceptedSize=config.media_upload_limit,
+                    cacheFolder=os.path.join(
+                        self.get_plugin_data_folder(), "timelapses"
+                    ),
+                )
+
+        return self.send_message(
+            eventID,
+            message,
+            media,
+            data.get("path", ""),
+            event_configuration.get("priority", DEFAULT_PRIORITY),
+            trace,
+        )
+
+    def start_script(self, eventName, which, trace: Trace) -> Future:
+        # Returns the future of the script, or None when there is nothing to run
+        config = self.config
+        if config.allow_scripts == False:
+            return None
+
+        if (which == "before" and config.script_before == "") or (
+            which == "after" and config.script_after == ""
+        ):
+            return None
 
-            return self.send_message(eventID, message, media)
+        # The trace waits for the script to be recorded
+        trace.hold()
+
+        def run():
+            try:
+                with trace.span("script_" + which):
+                    return self.exec_script(eventName, which)
+            finally:
+                trace.release()
+
+        return self.scriptPool.submit(run)
 
     def exec_script(self, eventName, which=""):
         # I want to be sure that the scripts are allowed by the special configuration flag
-        scripts_allowed = self._settings.get(["allow_scripts"], merged=True)
-        if scripts_allowed is None or scripts_allowed == False:
+        config = self.config
+        if config.allow_scripts == False:
             return ""
 
         # Finding which one should be used.
         script_to_exec = None
         if which == "before":
-            script_to_exec = self._settings.get(["script_before"], merged=True)
+            script_to_exec = config.script_before
 
         elif which == "after":
-            script_to_exec = self._settings.get(["script_after"], merged=True)  # type: ignore
+            script_to_exec = config.script_after
 
         # Finally exec the script
         out = ""
@@ -523,28 +874,69 @@ class OctorantPlugin(
                 and len(script_to_exec) > 0
                 and os.path.exists(script_to_exec)
             ):
-                out = subprocess.check_output(script_to_exec)
+                started = time.monotonic()
+                try:
+                    out = subprocess.check_output(
+                        script_to_exec, timeout=config.script_timeout or None
+                    )
+                finally:
+                    metrics.script_duration.observe(
+                        time.monotonic() - started, which=which
+                    )
+        except subprocess.TimeoutExpired as err:
+            self._logger.warning(
+                "{}:{} Script stopped after {}s".format(eventName, which, err.timeout)
+            )
+            out = err
         except (OSError, subprocess.CalledProcessError) as err:
             out = err
         finally:
             self._logger.debug("{}:{} > Output: '{}'".format(eventName, which, out))
             return out
 
-    def send_message(self, eventID, message, media: Media = None):
+    def send_message(
+        self,
+        eventID,
+        message,
+        media: Media = None,
+        job="",
+        priority=DEFAULT_PRIORITY,
+        trace: Trace = None,
+    ):
         # return false if no URL is provided
-        if "http" not in self._settings.get(["url"], merged=True):
+        if len(self.router.destinations(eventID)) == 0:
             return False
 
-        # exec "before" script if any
+        if trace is None:
+            trace = self.tracer.start(eventID)
+            try:
+                return self.send_message(eventID, message, media, job, priority, trace)
+            finally:
+                trace.release()
+
+        # exec "before" script if any, the media is captured once it is done
         eventManager().fire("plugin_octorant_before_notify", {"event": eventID})
-        self.exec_script(eventID, "before")
+        before = self.start_script(eventID, "before", trace)
+
+        # The trace waits for the "after" script and the event
+        trace.hold()
 
-        # Send to Discord WebHook
-        self.discord.send_message(message, media)
+        def after():
+            # exec "after" script if any, once the media is captured
+            script = self.start_script(eventID, "after", trace)
+            if script is None:
+                after_notify(None)
+            else:
+                script.add_done_callback(after_notify)
 
-        # exec "after" script if any
-        self.exec_script(eventID, "after")
-        eventManager().fire("plugin_octorant_after_notify", {"event": eventID})
+        def after_notify(_):
+            eventManager().fire("plugin_octorant_after_notify", {"event": eventID})
+            trace.release()
+
+        # Send to the Discord WebHooks of the event
+        self.router.send_message(
+            message, media, eventID, job, priority, trace, before, after
+        )
 
         return True
 
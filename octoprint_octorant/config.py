@@ -0,0 +1,268 @@
+# coding=utf-8
+
+# Immutable snapshot of the plugin settings.
+#
+# Reading OctoPrint settings walks the whole layered settings tree on every call, which
+# adds up when done on every progress tick and every event. The plugin builds one of
+# these at startup and every time the settings are saved, then swaps it atomically.
+# The webcam settings of OctoPrint itself are refreshed when OctoPrint saves them.
+
+from dataclasses import dataclass, replace
+from types import MappingProxyType
+
+from .messages import MessageTemplate
+
+
+@dataclass(frozen=True)
+class Config:
+    # Discord
+    url: str
+    username: str
+    avatar: str
+
+    # Every webhook by name, including the one above as "default"
+    webhooks: MappingProxyType
+
+    # Messages, and their compiled templates
+    events: MappingProxyType
+    templates: MappingProxyType
+
+    # Scripts
+    allow_scripts: bool
+    script_before: str
+    script_after: str
+    script_timeout: int
+
+    # Progress
+    progress_percentage_enabled: bool
+    progress_percentage_step: int
+    progress_time_enabled: bool
+    progress_time_step: int
+    progress_height_enabled: bool
+    progress_height_step: float
+    progress_throttle_enabled: bool
+    progress_throttle_step: int
+    progress_edit_in_place: bool
+
+    # Sender
+    http_engine: str
+    http_pool_size: int
+    http_idle_timeout: int
+    media_workers: int
+    media_timeout: int
+    media_upload_limit: int
+    queue_capacity: int
+    queue_aging: int
+    batch_window: float
+    outbox_enabled: bool
+    outbox_base_delay: int
+    outbox_max_delay: int
+    outbox_max_attempts: int
+
+    # GCode thumbnails
+    thumbnails_cache_size: int
+    thumbnails_disk_cache: bool
+    thumbnails_header_budget: int
+    thumbnails_tail_budget: int
+    thumbnails_use_mmap: bool
+    thumbnails_target_width: int
+    thumbnails_target_height: int
+    thumbnails_encode: str
+    thumbnails_quality: int
+
+    # Whether an enabled event sends the thumbnail of the GCode
+    thumbnails_used: bool
+
+    # Timelapses
+    timelapse_transcode: bool
+    timelapse_transcode_timeout: int
+    timelapse_min_bitrate: int
+    timelapse_fallback: str
+
+    # Notification traces
+    tracing_buffer_size: int
+    tracing_export: bool
+
+    # Webcam snapshots
+    snapshot_max_width: int
+    snapshot_max_height: int
+    snapshot_quality: int
+    snapshot_lossless_transform: bool
+    snapshot_cache_ttl: float
+
+    # OctoPrint < 1.9 webcam settings
+    webcam_snapshot_url: str
+    webcam_ffmpeg: str
+    webcam_flipH: bool
+    webcam_flipV: bool
+    webcam_rotate90: bool
+
+    @classmethod
+    def from_settings(cls, settings):
+        events = settings.get(["events"], merged=True) or {}
+
+        url = settings.get(["url"], merged=True) or ""
+        username = settings.get(["username"], merged=True) or ""
+        avatar = settings.get(["avatar"], merged=True) or ""
+
+        webhooks = {
+            "default": {
+                "url": url,
+                "username": username,
+                "avatar": avatar,
+                "thread_id": 0,
+            }
+        }
+        for name, webhook in (settings.get(["webhooks"], merged=True) or {}).items():
+            # Username and avatar are the ones of the default webhook unless set
+            webhooks[name] = {
+                "url": webhook.get("url") or "",
+                "username": webhook.get("username") or username,
+                "avatar": webhook.get("avatar") or avatar,
+                "thread_id": int(webhook.get("thread_id") or 0),
+            }
+
+        return cls(
+            url=url,
+            username=username,
+            avatar=avatar,
+            webhooks=MappingProxyType(
+                {name: MappingProxyType(webhook) for name, webhook in webhooks.items()}
+            ),
+            events=MappingProxyType(
+                {
+                    eventID: MappingProxyType(dict(configuration))
+                    for eventID, configuration in events.items()
+                }
+            ),
+            templates=MappingProxyType(
+                {
+                    eventID: MessageTemplate(configuration.get("message") or "")
+                    for eventID, configuration in events.items()
+                }
+            ),
+            allow_scripts=settings.get_boolean(["allow_scripts"], merged=True) == True,
+            script_before=settings.get(["script_before"], merged=True) or "",
+            script_after=settings.get(["script_after"], merged=True) or "",
+            script_timeout=settings.get_int(["script_timeout"], merged=True) or 0,
+            progress_percentage_enabled=settings.get_boolean(
+                ["progress", "percentage_enabled"], merged=True
+            )
+            == True,
+            progress_percentage_step=settings.get_int(
+                ["progress", "percentage_step"], merged=True
+            ),
+            progress_time_enabled=settings.get_boolean(
+                ["progress", "time_enabled"], merged=True
+            )
+            == True,
+            progress_time_step=settings.get_int(["progress", "time_step"], merged=True),
+            progress_height_enabled=settings.get_boolean(
+                ["progress", "height_enabled"], merged=True
+            )
+            == True,
+            progress_height_step=settings.get_float(
+                ["progress", "height_step"], merged=True
+            ),
+            progress_throttle_enabled=settings.get_boolean(
+                ["progress", "throttle_enabled"], merged=True
+            )
+            == True,
+            progress_throttle_step=settings.get_int(
+                ["progress", "throttle_step"], merged=True
+            ),
+            progress_edit_in_place=settings.get_boolean(
+                ["progress", "edit_in_place"], merged=True
+            )
+            == True,
+            http_engine=settings.get(["http", "engine"], merged=True) or "thread",
+            http_pool_size=settings.get_int(["http", "pool_size"], merged=True),
+            http_idle_timeout=settings.get_int(["http", "idle_timeout"], merged=True),
+            media_workers=settings.get_int(["media", "workers"], merged=True),
+            media_timeout=settings.get_int(["media", "timeout"], merged=True),
+            media_upload_limit=settings.get_int(["media", "upload_limit"], merged=True),
+            queue_capacity=settings.get_int(["queue", "capacity"], merged=True),
+            queue_aging=settings.get_int(["queue", "aging"], merged=True),
+            batch_window=settings.get_float(["batch", "window"], merged=True),
+            outbox_enabled=settings.get_boolean(["outbox", "enabled"], merged=True)
+            == True,
+            outbox_base_delay=settings.get_int(["outbox", "base_delay"], merged=True),
+            outbox_max_delay=settings.get_int(["outbox", "max_delay"], merged=True),
+            outbox_max_attempts=settings.get_int(
+                ["outbox", "max_attempts"], merged=True
+            ),
+            thumbnails_cache_size=settings.get_int(
+                ["thumbnails", "cache_size"], merged=True
+            ),
+            thumbnails_disk_cache=settings.get_boolean(
+                ["thumbnails", "disk_cache"], merged=True
+            )
+            == True,
+            thumbnails_header_budget=settings.get_int(
+                ["thumbnails", "header_budget"], merged=True
+            ),
+            thumbnails_tail_budget=settings.get_int(
+                ["thumbnails", "tail_budget"], merged=True
+            ),
+            thumbnails_use_mmap=settings.get_boolean(
+                ["thumbnails", "use_mmap"], merged=True
+            )
+            == True,
+            thumbnails_target_width=settings.get_int(
+                ["thumbnails", "target_width"], merged=True
+            ),
+            thumbnails_target_height=settings.get_int(
+                ["thumbnails", "target_height"], merged=True
+            ),
+            thumbnails_encode=settings.get(["thumbnails", "encode"], merged=True) or "",
+            thumbnails_quality=settings.get_int(["thumbnails", "quality"], merged=True),
+            thumbnails_used=any(
+                configuration.get("enabled") == True
+                and configuration.get("media") == "thumbnail"
+                for configuration in events.values()
+            ),
+            timelapse_transcode=settings.get_boolean(
+                ["timelapse", "transcode"], merged=True
+            )
+            == True,
+            timelapse_transcode_timeout=settings.get_int(
+                ["timelapse", "transcode_timeout"], merged=True
+            ),
+            timelapse_min_bitrate=settings.get_int(
+                ["timelapse", "min_bitrate"], merged=True
+            ),
+            timelapse_fallback=settings.get(["timelapse", "fallback"], merged=True)
+            or "clip",
+            tracing_buffer_size=settings.get_int(
+                ["tracing", "buffer_size"], merged=True
+            ),
+            tracing_export=settings.get_boolean(["tracing", "export"], merged=True)
+            == True,
+            snapshot_max_width=settings.get_int(["snapshot", "max_width"], merged=True),
+            snapshot_max_height=settings.get_int(
+                ["snapshot", "max_height"], merged=True
+            ),
+            snapshot_quality=settings.get_int(["snapshot", "quality"], merged=True),
+            snapshot_lossless_transform=settings.get_boolean(
+                ["snapshot", "lossless_transform"], merged=True
+            )
+            == True,
+            snapshot_cache_ttl=settings.get_float(
+                ["snapshot", "cache_ttl"], merged=True
+            ),
+            **cls.core_settings(settings),
+        )
+
+    @staticmethod
+    def core_settings(settings):
+        # Settings of OctoPrint, saved without on_settings_save of the plugin
+        return dict(
+            webcam_snapshot_url=settings.global_get(["webcam", "snapshot"]) or "",
+            webcam_ffmpeg=settings.global_get(["webcam", "ffmpeg"]) or "",
+            webcam_flipH=settings.global_get_boolean(["webcam", "flipH"]) == True,
+            webcam_flipV=settings.global_get_boolean(["webcam", "flipV"]) == True,
+            webcam_rotate90=settings.global_get_boolean(["webcam", "rotate90"]) == True,
+        )
+
+    def with_core_settings(self, settings):
+        return replace(self, **Config.core_settings(settings))
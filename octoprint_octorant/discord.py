@@ -2,35 +2,214 @@
 
 # Simple module to send messages through a Discord WebHook
 
+import json
 import logging
+import os
 import time
 import requests
 import sys
-import queue
 
-from threading import Thread
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
+from requests.adapters import HTTPAdapter
+from . import metrics
+from .config import Config
 from .media import Media
+from .multipart import MultipartEncoder, UploadFile, has_upload_file
+from .outbox import Outbox
+from .outqueue import DEFAULT_PRIORITY, OutboundQueue
+from .ratelimit import RateLimiter
+from .tracing import Trace
+
+# How many times a message is retried when Discord still rate limits it
+MAX_RATE_LIMITED_ATTEMPTS = 5
+
+# Only the latest of these messages matters when several are waiting to be sent.
+# Everything else (e.g. printing_done) is always delivered.
+COALESCABLE_EVENTS = ["printing_progress", "transfer_progress"]
+
+# With progress.edit_in_place, these events start a new progress message: the next
+# progress is posted as a new message instead of editing the previous one.
+PROGRESS_RESETS = {
+    "printing_started": "printing_progress",
+    "printing_done": "printing_progress",
+    "printing_cancelled": "printing_progress",
+    "printing_failed": "printing_progress",
+    "transfer_started": "transfer_progress",
+    "transfer_done": "transfer_progress",
+    "transfer_failed": "transfer_progress",
+}
+
+# Discord limits for a message sent with several embeds
+MAX_BATCH_MESSAGES = 10
+MAX_EMBED_DESCRIPTION = 4096
+MAX_EMBEDS_TOTAL = 6000
+
+# Attachments shown inside their embed, the others are shown below the embeds
+EMBEDDABLE_IMAGES = [".png", ".jpg", ".jpeg", ".gif", ".webp"]
+
+
+class SharedMedia:
+    # A media captured once for all the destinations of a message. The capture is
+    # cancelled once every destination has discarded its message.
+    def __init__(self, future: Future, users, before: Future = None) -> None:
+        self.future = future
+        self.users = users
+        self.lock = Lock()
+
+        # The media timeout starts once the "before" script is done, as the capture
+        # waits for it
+        self.started = None
+        if before is None:
+            self.start()
+        else:
+            before.add_done_callback(lambda _: self.start())
+
+        # Messages already discarded, each one counts once
+        self.released = set()
+
+    def release(self, message):
+        with self.lock:
+            if id(message) in self.released:
+                return
+
+            self.released.add(id(message))
+            if len(self.released) < self.users:
+                return
+
+        self.future.cancel()
+
+    def start(self):
+        self.started = time.time()
 
 
 class Message:
-    def __init__(self, content: str, media: Media = None) -> None:
+    def __init__(
+        self,
+        content: str,
+        media: Media = None,
+        event_id="",
+        coalesce_key=None,
+        priority=DEFAULT_PRIORITY,
+    ) -> None:
         self.content = content
         self.media: Media = media
 
+        self.event_id = event_id
+        self.coalesce_key = coalesce_key
+        self.priority = priority
+
+        # Set when the media is being fetched in the media pool, and how long the
+        # message waits for it
+        self.media_future: Future = None
+        self.media_timeout = 0
+
+        # Set when the capture is shared with the other destinations
+        self.shared_media: SharedMedia = None
+
+        # Media once grabbed, kept for the next attempts
+        self.file = None
+
+        # Failed attempts so far, and the entry of the message in the outbox
+        self.attempts = 0
+        self.outbox_id = None
+
+        # Timing of the notification, shared with its other destinations
+        self.trace: Trace = None
+
+    @property
+    def media_deadline(self):
+        # Not known until the capture starts, then the media timeout after it
+        if self.shared_media is None:
+            return 0
+
+        started = self.shared_media.started
+        if started is None:
+            return time.time() + self.media_timeout
+
+        return started + self.media_timeout
+
+    def pending(self):
+        # True while the media is still being prepared
+        return (
+            self.media_future is not None
+            and not self.media_future.done()
+            and time.time() < self.media_deadline
+        )
+
+    def transcoding(self):
+        # True while a long media (e.g. a timelapse conversion) is being prepared
+        return self.pending() and self.media is not None and self.media.timeout > 0
+
+    def cancel(self):
+        # No need to grab a media that won't be sent
+        if self.shared_media is not None:
+            # Unless another destination still needs it
+            self.shared_media.release(self)
+        elif self.media_future is not None:
+            self.media_future.cancel()
+
+    def span(self, name, started, duration, **attributes):
+        if self.trace is not None:
+            self.trace.add(name, started, duration, **attributes)
+
+    def finish(self, webhook, outcome):
+        # The trace is recorded once every destination is done with the notification
+        if self.trace is not None:
+            self.trace.release(webhook, outcome)
+            self.trace = None
+
 
 class DiscordMessage(Thread):
-    def __init__(self, logger: logging.Logger):
-        Thread.__init__(self, daemon=True)
+    def __init__(
+        self,
+        logger: logging.Logger,
+        pool_size=2,
+        idle_timeout=60,
+        name="default",
+    ):
+        Thread.__init__(self, name="octorant-{}".format(name), daemon=True)
 
         self._logger = logger
 
+        # Name of the webhook in the settings
+        self.webhook = name
+
         self.url = ""
         self.username = ""
         self.avatar = ""
         self.thread_id = 0
 
-        self.queue = queue.Queue()
-        self.stop_until = 0
+        # Set when the webhook is removed, to end the thread
+        self.stopped = False
+
+        self.queue = OutboundQueue(self._logger, name=name)
+        self.rate_limiter = RateLimiter()
+
+        # Messages queued within this many seconds are sent together
+        self.batch_window = 0
+        self.upload_limit = 0
+
+        # Progress messages are edited instead of being posted again, event -> message id
+        self.edit_in_place = False
+        self.progress_messages = {}
+
+        # Messages that couldn't be delivered, retried later
+        self.outbox: Outbox = None
+        self.outbox_path = None
+
+        # HTTP session, only used from the sender thread
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.session: requests.Session = None
+        self.adapter: HTTPAdapter = None
+        self.session_last_used = 0
+        self.session_reset = False
+
+        # Media are captured ahead of time by the media pool of the router, once
+        # for all the destinations. A message waits this long for its media.
+        self.media_timeout = 30
 
         self.start()
         self._logger.debug("Discord thread has started")
@@ -41,104 +220,688 @@ class DiscordMessage(Thread):
         self.avatar = avatar
         self.thread_id = thread_id
 
-    def send_message(self, content: str, media: Media = None):
-        if self.stop_until > time.time():
-            self._logger.debug(
-                "Rate limited by Discord until: {}".format(self.stop_until)
+    def apply_config(self, config: Config, webhook=None):
+        if webhook is None:
+            self.set_config(config.url, config.username, config.avatar)
+        else:
+            self.set_config(
+                webhook["url"],
+                webhook["username"],
+                webhook["avatar"],
+                webhook["thread_id"],
             )
+
+        self.set_session_config(config.http_pool_size, config.http_idle_timeout)
+        self.media_timeout = config.media_timeout
+        self.queue.set_config(config.queue_capacity, config.queue_aging)
+        self.set_batch_config(config.batch_window, config.media_upload_limit)
+        self.edit_in_place = config.progress_edit_in_place
+
+        # The webhook may be usable now, retry the outbox right away
+        self.queue.wake()
+
+    def stop(self):
+        self.stopped = True
+        self.queue.wake()
+
+    def set_batch_config(self, window=0, upload_limit=0):
+        self.batch_window = window
+        self.upload_limit = upload_limit
+
+    def set_outbox(self, path, base_delay=5, max_delay=900, max_attempts=10):
+        if path != self.outbox_path:
+            # The previous database is closed once the sender is done with it
+            self.outbox_path = path
+            self.outbox = None
+            if path is not None:
+                try:
+                    self.outbox = Outbox(self._logger, path)
+                except Exception:
+                    self._logger.exception("Unable to open the outbox {}".format(path))
+
+        if self.outbox is not None:
+            self.outbox.base_delay = base_delay
+            self.outbox.max_delay = max_delay
+            self.outbox.max_attempts = max_attempts
+
+        # Replays the messages left over by the previous run
+        self.queue.wake()
+
+    def set_session_config(self, pool_size=2, idle_timeout=60):
+        if pool_size == self.pool_size and idle_timeout == self.idle_timeout:
             return
 
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+        # The session belongs to the sender thread, let it rebuild it on next use
+        self.session_reset = True
+
+    def get_session(self) -> requests.Session:
+        if self.session is not None:
+            if self.session_reset:
+                self._logger.debug("HTTP session settings changed, rebuilding it")
+                self.close_session()
+            elif (
+                self.idle_timeout > 0
+                and time.time() - self.session_last_used > self.idle_timeout
+            ):
+                # Discord (or any proxy in between) has most likely closed the
+                # idle connections already, don't try to reuse them.
+                self._logger.debug(
+                    "HTTP session idle for more than {}s, closing it".format(
+                        self.idle_timeout
+                    )
+                )
+                self.close_session()
+
+        if self.session is None:
+            self.session_reset = False
+            self.adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=max(1, self.pool_size)
+            )
+            self.session = requests.Session()
+            self.session_last_used = time.time()
+            self.session.mount("https://", self.adapter)
+            self.session.mount("http://", self.adapter)
+            self._logger.debug(
+                "New HTTP session (pool size: {})".format(self.pool_size)
+            )
+
+        return self.session
+
+    def close_session(self):
+        if self.session is not None:
+            self.session.close()
+
+        self.session = None
+        self.adapter = None
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        try:
+            return self.timed_request(method, url, **kwargs)
+        except requests.ConnectionError as error:
+            if isinstance(error, requests.Timeout):
+                raise
+
+            # Most likely a kept-alive connection closed by the other side,
+            # retry once on a brand new session.
+            self._logger.debug(
+                "ConnectionError on pooled connection, reconnecting: {}".format(error)
+            )
+            self.close_session()
+
+            data = kwargs.get("data")
+            if isinstance(data, MultipartEncoder):
+                data.rewind()
+
+            return self.timed_request(method, url, **kwargs)
+
+    def connection_count(self):
+        # Connections opened so far by the pools of the current session
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def timed_request(self, method, url, **kwargs) -> requests.Response:
+        session = self.get_session()
+
+        connections_before = self.connection_count()
+        started = time.monotonic()
+
+        response = session.request(method, url, **kwargs)
+
+        total = time.monotonic() - started
+        self.session_last_used = time.time()
+        self.count_request(method, response, total)
+
+        # A new connection means that the TCP+TLS handshake is part of the
+        # time until headers, a reused one only pays for the transfer.
+        self._logger.debug(
+            "{} {} in {:.3f}s ({} connection, headers after {:.3f}s, body {:.3f}s)".format(
+                method,
+                response.status_code,
+                total,
+                "new" if self.connection_count() > connections_before else "reused",
+                response.elapsed.total_seconds(),
+                max(0, total - response.elapsed.total_seconds()),
+            )
+        )
+
+        return response
+
+    def count_request(self, method, response, duration):
+        metrics.http_duration.observe(duration, webhook=self.webhook, method=method)
+        metrics.http_responses.inc(
+            webhook=self.webhook, method=method, status=response.status_code
+        )
+        metrics.upload_bytes.inc(
+            int(response.request.headers.get("Content-Length") or 0),
+            webhook=self.webhook,
+        )
+
+    def send_message(
+        self,
+        content: str,
+        media: Media,
+        shared_media: SharedMedia,
+        event_id="",
+        job="",
+        priority=DEFAULT_PRIORITY,
+        trace: Trace = None,
+    ):
         # Setup variables
-        message = Message(content, media)
+        coalesce_key = None
+        if event_id in COALESCABLE_EVENTS:
+            coalesce_key = (event_id, job)
+
+        message = Message(content, media, event_id, coalesce_key, priority)
+        if trace is not None:
+            trace.hold()
+            message.trace = trace
+
+        if self.edit_in_place and event_id in PROGRESS_RESETS:
+            # The waiting progress would edit the message of the previous job
+            self.queue.discard_event(PROGRESS_RESETS[event_id])
+
+        # The media is already being captured for all the destinations, unless the
+        # message will be discarded by the sender anyway.
+        if shared_media is not None and self.url != "" and message.content != "":
+            message.media_timeout = max(self.media_timeout, message.media.timeout)
+            message.media_future = shared_media.future
+            message.shared_media = shared_media
+
+            # The message is skipped by the sender until its media is ready
+            message.media_future.add_done_callback(lambda _: self.queue.wake())
 
         self._logger.debug(
-            "Adding message to queue: {} (rate-limit: {})".format(
-                message.content, self.stop_until
+            "Adding message to queue: {} (rate-limit delay: {:.1f}s)".format(
+                message.content, self.rate_limiter.delay(self.url)
             )
         )
         self.queue.put(message)
 
-    def run(self):
-        while True:
-            message: Message = self.queue.get()
+    def target(self, message_id=None, wait=False):
+        # (method, url, rate limit route) to post a new message, or edit message_id
+        url = self.url
+        route = self.url
+        method = "POST"
+        if message_id is not None:
+            url += "/messages/{}".format(message_id)
+            route += "/messages"
+            method = "PATCH"
 
-            if self.stop_until > time.time():
-                self.queue.task_done()
-                self._logger.warn(
-                    "Not sent because of rate-limiting until {}".format(self.stop_until)
-                )
-                continue
+        query = []
+        if self.thread_id > 0:
+            query.append("thread_id={}".format(self.thread_id))
+        if wait:
+            # Discord answers with the message, and its id
+            query.append("wait=true")
+        if len(query) > 0:
+            url += "?" + "&".join(query)
 
-            file = None
+        return method, url, route
 
-            # If not setup, just close already
-            if self.url == "":
-                self.queue.task_done()
-                self._logger.debug("DiscordMessage: No Webhook URL provided")
-                continue
+    def rate_limit_delay(self, route):
+        # Wait for the bucket to be reset rather than getting a 429
+        delay = self.rate_limiter.delay(route)
+        if delay > 0:
+            self._logger.debug(
+                "Waiting {:.2f}s for Discord rate-limit to reset".format(delay)
+            )
+            metrics.rate_limit_wait.inc(delay, webhook=self.webhook)
 
-            if message.content == "":
-                self.queue.task_done()
-                self._logger.debug("DiscordMessage: Content is empty")
-                continue
+        return delay
 
-            # Grab the media
-            if message.media is not None:
-                file = message.media.get()
+    def rate_limited(self, route, response, attempt) -> bool:
+        # Records the limits announced by Discord, True when the request must be retried
+        body = None
+        if response.status_code == 429:
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
 
-            # Setup the payload
-            payload = {
-                "content": message.content,
-            }
+        retry_after = self.rate_limiter.update(
+            route, response.status_code, response.headers, body
+        )
 
-            if self.username != "":
-                payload["username"] = self.username
+        if response.status_code != 429:
+            return False
 
-            if self.avatar != "":
-                payload["avatar_url"] = self.avatar
+        self._logger.debug(body)
+        self._logger.warn(
+            "Rate limited by Discord API, retrying in {:.2f}s (attempt {}/{})".format(
+                retry_after, attempt, MAX_RATE_LIMITED_ATTEMPTS
+            )
+        )
+        return True
 
-            try:
-                response: requests.Response = requests.post(
-                    self.url
-                    + (
-                        "?thread_id={}".format(self.thread_id)
-                        if self.thread_id > 0
-                        else ""
-                    ),
+    def execute(self, payload, file, message_id=None, wait=False):
+        method, url, route = self.target(message_id, wait)
+
+        for attempt in range(1, MAX_RATE_LIMITED_ATTEMPTS + 1):
+            time.sleep(self.rate_limit_delay(route))
+
+            if has_upload_file(file) or "payload_json" in payload:
+                # Files on disk are streamed instead of being loaded in memory.
+                # payload_json is only accepted in a multipart body, even without files.
+                encoder = MultipartEncoder(payload, file)
+                response: requests.Response = self.request(
+                    method,
+                    url,
+                    data=encoder,
+                    headers={"Content-Type": encoder.content_type},
+                    timeout=60,
+                )
+            else:
+                response: requests.Response = self.request(
+                    method,
+                    url,
                     files=file,
                     data=payload,
                     timeout=60,
                 )
 
-                if response.status_code == 429:
-                    data = response.json()
-                    if int(data["retry_after"]) > 0:
-                        self.stop_until = time.time() + (
-                            int(data["retry_after"]) / 1000
-                        )
-
-                    self._logger.debug(data)
-                    self._logger.warn(
-                        "Rate limited by Discord API. Won't send message until {}".format(
-                            self.stop_until
-                        )
-                    )
-                else:
-                    self.stop_until = 0
+            if not self.rate_limited(route, response, attempt):
+                return response
+
+        self._logger.warn("Still rate limited by Discord API")
+        return response
 
-            except requests.ConnectTimeout:
-                self._logger.error(
-                    "ConnectTimeout triggered when sending message to Discord"
+    def deliver(self, payload, file, message_id=None, wait=False) -> requests.Response:
+        # None when the message should be tried again later
+        try:
+            response = self.execute(payload, file, message_id, wait)
+        except requests.Timeout:
+            self._logger.error("Timeout triggered when sending message to Discord")
+            return None
+        except requests.ConnectionError:
+            self._logger.error(
+                "ConnectionError triggered when sending message to Discord"
+            )
+            return None
+        except requests.RequestException as error:
+            # e.g. an invalid answer, the message is tried again later
+            self._logger.error(
+                "Error triggered when sending message to Discord: {}".format(error)
+            )
+            return None
+
+        return self.check_response(response, message_id)
+
+    def check_response(self, response, message_id=None):
+        # None when the message should be tried again later
+        if response.status_code == 429 or response.status_code >= 500:
+            self._logger.error(
+                "Discord API unavailable ({})".format(response.status_code)
+            )
+            return None
+
+        if message_id is not None and response.status_code == 404:
+            # The message to edit has been deleted, the caller posts a new one
+            return response
+
+        if response.status_code >= 400:
+            # Retrying won't change anything, e.g. a deleted webhook
+            self._logger.error(
+                "Message rejected by Discord API ({}): {}".format(
+                    response.status_code, response.text
                 )
-            except requests.ConnectionError:
-                self._logger.error(
-                    "ConnectionError triggered when sending message to Discord"
+            )
+
+        return response
+
+    def wait_media(self, message: Message):
+        if message.media_future is None:
+            return None
+
+        try:
+            return message.media_future.result(
+                timeout=max(0, message.media_deadline - time.time())
+            )
+        except FutureTimeoutError:
+            message.cancel()
+            self._logger.warn(
+                "Media {} not ready after {}s, sending message without it".format(
+                    message.media.type, message.media_timeout
                 )
+            )
+        except:
+            self._logger.error(sys.exc_info())
 
-            except:
-                # In case of a general exception, return so that the thread gets killed and restart correctly next time.
-                self._logger.error(sys.exc_info())
-                return
+        return None
+
+    def postpone(self, message: Message):
+        outbox = self.outbox
+        if outbox is None:
+            self._logger.error("Message dropped: {}".format(message.content))
+            metrics.messages_dropped.inc(webhook=self.webhook, reason="failed")
+            message.finish(self.webhook, "failed")
+            return
+
+        message.attempts += 1
+        message.outbox_id = outbox.postpone(
+            message.outbox_id,
+            message.event_id,
+            message.content,
+            message.priority,
+            message.file,
+            message.attempts,
+        )
+        if message.outbox_id is None:
+            metrics.messages_dropped.inc(webhook=self.webhook, reason="given_up")
+            message.finish(self.webhook, "given_up")
+        else:
+            message.finish(self.webhook, "postponed")
+
+    def prepare(self, message: Message):
+        # Wait for the media grabbed by the media pool
+        if message.file is None:
+            message.file = self.wait_media(message)
+
+        return message
+
+    def editable(self, message: Message):
+        # Progress messages edited in place are always sent on their own
+        return self.edit_in_place and message.coalesce_key is not None
+
+    def fits(self, batch, message: Message):
+        # Whether the message can be sent in the same request as the batch
+        if len(batch) >= MAX_BATCH_MESSAGES or self.editable(message):
+            return False
+
+        messages = batch + [self.prepare(message)]
+        if any(len(m.content) > MAX_EMBED_DESCRIPTION for m in messages):
+            return False
+
+        if sum(len(m.content) for m in messages) > MAX_EMBEDS_TOTAL:
+            return False
+
+        return self.upload_limit <= 0 or self.upload_size(messages) <= self.upload_limit
+
+    def upload_size(self, messages):
+        size = 0
+        for message in messages:
+            if message.file is not None and "file" in message.file:
+                _, content = message.file["file"]
+                size += (
+                    content.size if isinstance(content, UploadFile) else len(content)
+                )
+
+        return size
+
+    def batchable(self, message: Message):
+        # Whether the next messages may be sent with this one
+        return (
+            self.batch_window > 0
+            and message.content != ""
+            and not self.editable(message)
+        )
+
+    def batch_span(self, batch, started):
+        for message in batch:
+            message.span(
+                "batch", started, time.monotonic() - started, webhook=self.webhook
+            )
+
+    def collect(self, batch):
+        # Adds the messages queued during the batch window, as long as they fit
+        for message in batch:
+            self.prepare(message)
+
+        deadline = time.monotonic() + self.batch_window
+        rejected = []
+
+        def accept(message):
+            if self.fits(batch, message):
+                return True
+
+            rejected.append(message)
+            return False
+
+        while time.monotonic() < deadline and len(rejected) == 0:
+            message = self.queue.get(timeout=deadline - time.monotonic(), accept=accept)
+            if message is not None:
+                batch.append(message)
+
+    def payload(self, messages):
+        # Returns the form fields and the files of the request
+        if len(messages) == 1:
+            payload = {
+                "content": messages[0].content,
+            }
+            file = messages[0].file
+        else:
+            # One embed per message, with its media as an attachment
+            payload = {"embeds": [], "attachments": []}
+            file = {}
+            for message in messages:
+                embed = {"description": message.content}
+
+                if message.file is not None and "file" in message.file:
+                    filename, content = message.file["file"]
+                    filename = unique_filename(
+                        filename, [a["filename"] for a in payload["attachments"]]
+                    )
+
+                    index = len(payload["attachments"])
+                    payload["attachments"].append({"id": index, "filename": filename})
+                    file["files[{}]".format(index)] = (filename, content)
+
+                    if os.path.splitext(filename)[1].lower() in EMBEDDABLE_IMAGES:
+                        embed["image"] = {"url": "attachment://" + filename}
+
+                payload["embeds"].append(embed)
+
+        if self.username != "":
+            payload["username"] = self.username
+
+        if self.avatar != "":
+            payload["avatar_url"] = self.avatar
+
+        if len(messages) > 1:
+            payload = {"payload_json": json.dumps(payload)}
+
+        return payload, file
+
+    def sendable(self, messages):
+        # The messages that can be sent, with their media
+        # If not setup, just close already
+        if self.url == "":
+            self._logger.debug("DiscordMessage: No Webhook URL provided")
+            metrics.messages_dropped.inc(
+                len(messages), webhook=self.webhook, reason="no_url"
+            )
+            for message in messages:
+                message.finish(self.webhook, "no_url")
+            return []
+
+        for message in [m for m in messages if m.content == ""]:
+            self._logger.debug("DiscordMessage: Content is empty")
+            metrics.messages_dropped.inc(webhook=self.webhook, reason="empty")
+            message.finish(self.webhook, "empty")
+            messages.remove(message)
+
+        for message in messages:
+            self.prepare(message)
+
+        if len(messages) > 1:
+            self._logger.debug("Sending {} messages at once".format(len(messages)))
+
+        return messages
+
+    def reset_progress(self, messages):
+        # The next progress after these messages is posted as a new message
+        for message in messages:
+            if message.event_id in PROGRESS_RESETS:
+                self.progress_messages.pop(PROGRESS_RESETS[message.event_id], None)
+
+    def process(self, messages):
+        messages = self.sendable(messages)
+        if len(messages) == 0:
+            return
+
+        started = time.monotonic()
+        if len(messages) == 1 and self.editable(messages[0]):
+            response = self.send_progress(messages[0])
+        else:
+            self.reset_progress(messages)
+            payload, file = self.payload(messages)
+            response = self.deliver(payload, file)
+
+        self.complete(messages, started, response)
+
+    def complete(self, messages, started, response):
+        # Records the outcome of the request that sent the messages
+        for message in messages:
+            message.span(
+                "send",
+                started,
+                time.monotonic() - started,
+                webhook=self.webhook,
+                status=None if response is None else response.status_code,
+                batch=len(messages),
+            )
+
+        if response is None:
+            for message in messages:
+                self.postpone(message)
+            return
+
+        # The outbox may have been disabled while retrying its messages
+        outbox = self.outbox
+        if outbox is not None:
+            for message in messages:
+                if message.outbox_id is not None:
+                    outbox.remove(message.outbox_id)
+
+        if response.status_code < 400:
+            metrics.messages_sent.inc(len(messages), webhook=self.webhook)
+            outcome = "sent"
+        else:
+            metrics.messages_dropped.inc(
+                len(messages), webhook=self.webhook, reason="rejected"
+            )
+            outcome = "rejected"
+
+        for message in messages:
+            message.finish(self.webhook, outcome)
+
+    def send_progress(self, message: Message) -> requests.Response:
+        # Same as deliver, None when the message should be tried again later
+        message_id = self.progress_messages.get(message.event_id)
+        if message_id is not None:
+            payload, file = self.edit_payload(message)
+            response = self.deliver(payload, file, message_id)
+            if not self.progress_deleted(message, response):
+                return response
+
+        payload, file = self.payload([message])
+        response = self.deliver(payload, file, wait=True)
+        self.remember_progress(message, response)
+        return response
+
+    def edit_payload(self, message: Message):
+        # New text, and new attachment (or none) in place of the previous one
+        payload = {"content": message.content, "attachments": []}
+        file = None
+        if message.file is not None and "file" in message.file:
+            filename, content = message.file["file"]
+            payload["attachments"].append({"id": 0, "filename": filename})
+            file = {"files[0]": (filename, content)}
+
+        return {"payload_json": json.dumps(payload)}, file
+
+    def progress_deleted(self, message: Message, response) -> bool:
+        # True when the edited message is gone, and a new one must be posted
+        if response is None or response.status_code != 404:
+            return False
+
+        self._logger.debug("Progress message deleted, posting a new one")
+        del self.progress_messages[message.event_id]
+        return True
+
+    def remember_progress(self, message: Message, response):
+        if response is None or response.status_code >= 400:
+            return
+
+        try:
+            self.progress_messages[message.event_id] = response.json()["id"]
+        except (ValueError, KeyError, TypeError):
+            self._logger.debug("No message id in the answer of Discord")
+
+    def retry_outbox(self):
+        for message in self.outbox_due():
+            self.process([message])
+
+    def outbox_due(self):
+        # The messages of the outbox to send again now
+        outbox = self.outbox
+        if outbox is None or self.url == "":
+            return
+
+        for entry in outbox.due():
+            self._logger.debug(
+                "Retrying {} message from the outbox (attempt {})".format(
+                    entry.event_id, entry.attempts + 1
+                )
+            )
+
+            message = Message(entry.content, None, entry.event_id, None, entry.priority)
+            message.file = entry.file
+            message.attempts = entry.attempts
+            message.outbox_id = entry.id
+
+            yield message
+
+    def outbox_timeout(self):
+        # Time until the next message of the outbox is due, None to wait forever
+        outbox = self.outbox
+        if outbox is None or self.url == "":
+            return None
+
+        next_attempt = outbox.next_due()
+        if next_attempt is None:
+            return None
 
+        return max(0, next_attempt - time.time())
+
+    def work(self):
+        while not self.stopped:
+            self.retry_outbox()
+
+            message: Message = self.queue.get(timeout=self.outbox_timeout())
+            if message is None:
+                continue
+
+            batch = [message]
+            try:
+                if self.batchable(message):
+                    started = time.monotonic()
+                    self.collect(batch)
+                    self.batch_span(batch, started)
+
+                self.process(list(batch))
             finally:
-                self.queue.task_done()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def run(self):
+        # An unexpected error must not stop the notifications until OctoPrint restarts
+        while not self.stopped:
+            try:
+                self.work()
+            except Exception:
+                self._logger.exception("Discord sender failed, restarting it")
+                time.sleep(1)
+
+
+def unique_filename(filename, taken):
+    # Several snapshots in the same request would all be named snapshot.jpg
+    name, extension = os.path.splitext(filename)
+    candidate, index = filename, 1
+    while candidate in taken:
+        candidate = "{}-{}{}".format(name, index, extension)
+        index += 1
+
+    return candidate
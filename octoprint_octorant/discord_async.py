@@ -0,0 +1,292 @@
+# coding: utf-8
+
+# Discord sender running on asyncio, selected with http.engine: asyncio.
+#
+# The webhooks share one thread and its event loop, instead of a thread each, and their
+# requests are in flight at the same time. Each webhook still sends its own messages one
+# request at a time and in order, waiting for its rate limits. The queue, batching,
+# outbox and progress edits are the ones of the threaded sender.
+#
+# It needs httpx (pip install httpx), the threaded sender is used when it is missing.
+
+import asyncio
+import threading
+import time
+
+from .discord import MAX_RATE_LIMITED_ATTEMPTS, DiscordMessage, Message
+from .multipart import CHUNK_SIZE_BYTES, MultipartEncoder
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def available():
+    return httpx is not None
+
+
+class EventLoopThread:
+    # The event loop of every asyncio sender, started with the first one
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop = None
+
+    def submit(self, coroutine):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.loop.run_forever, name="octorant-asyncio", daemon=True
+                ).start()
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+eventLoop = EventLoopThread()
+
+
+class AsyncDiscordMessage(DiscordMessage):
+    def __init__(self, logger, *args, **kwargs):
+        # Set once the sender runs in the event loop
+        self.loop: asyncio.AbstractEventLoop = None
+        self.wakeup: asyncio.Event = None
+        self.client = None
+
+        DiscordMessage.__init__(self, logger, *args, **kwargs)
+
+    def start(self):
+        # Runs in the shared event loop rather than in its own thread
+        self.task = eventLoop.submit(self.run_async())
+
+    def notify(self):
+        # Called from any thread when a message is queued
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def blocking(self, function, *args):
+        # File and database accesses run in the default executor, not in the event loop
+        return await self.loop.run_in_executor(None, function, *args)
+
+    async def wait(self, timeout=None):
+        # Until a message is queued, a media is ready, or the timeout
+        timeout = self.queue.media_wait(timeout)
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def get_client(self):
+        if self.client is not None and self.session_reset:
+            self._logger.debug("HTTP session settings changed, rebuilding it")
+            await self.close_client()
+
+        if self.client is None:
+            self.session_reset = False
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max(1, self.pool_size),
+                    max_keepalive_connections=max(1, self.pool_size),
+                    # Discord (or a proxy) most likely closed the idle connections
+                    keepalive_expiry=self.idle_timeout
+                    if self.idle_timeout > 0
+                    else None,
+                ),
+                timeout=60,
+            )
+            self._logger.debug("New HTTP client (pool size: {})".format(self.pool_size))
+
+        return self.client
+
+    async def close_client(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+        self.client = None
+
+    async def request(self, method, url, data, encoder: MultipartEncoder = None):
+        try:
+            return await self.timed_request(method, url, data, encoder)
+        except httpx.TransportError as error:
+            if isinstance(error, httpx.TimeoutException):
+                raise
+
+            # Most likely a kept-alive connection closed by the other side,
+            # retry once on a brand new client.
+            self._logger.debug(
+                "Transport error on pooled connection, reconnecting: {}".format(error)
+            )
+            await self.close_client()
+
+            if encoder is not None:
+                encoder.rewind()
+
+            return await self.timed_request(method, url, data, encoder)
+
+    async def timed_request(self, method, url, data, encoder: MultipartEncoder = None):
+        client = await self.get_client()
+        started = time.monotonic()
+
+        if encoder is None:
+            response = await client.request(method, url, data=data)
+        else:
+            # Files on disk are streamed instead of being loaded in memory
+            response = await client.request(
+                method,
+                url,
+                content=stream(encoder),
+                headers={
+                    "Content-Type": encoder.content_type,
+                    "Content-Length": str(len(encoder)),
+                },
+            )
+
+        total = time.monotonic() - started
+        self.count_request(method, response, total)
+        self._logger.debug(
+            "{} {} in {:.3f}s".format(method, response.status_code, total)
+        )
+
+        return response
+
+    async def execute(self, payload, file, message_id=None, wait=False):
+        method, url, route = self.target(message_id, wait)
+
+        for attempt in range(1, MAX_RATE_LIMITED_ATTEMPTS + 1):
+            await asyncio.sleep(self.rate_limit_delay(route))
+
+            encoder = None
+            if file or "payload_json" in payload:
+                # payload_json is only accepted in a multipart body, even without files
+                encoder = MultipartEncoder(payload, file)
+
+            response = await self.request(method, url, payload, encoder)
+            if not self.rate_limited(route, response, attempt):
+                return response
+
+        self._logger.warn("Still rate limited by Discord API")
+        return response
+
+    async def deliver(self, payload, file, message_id=None, wait=False):
+        # None when the message should be tried again later
+        try:
+            response = await self.execute(payload, file, message_id, wait)
+        except httpx.TimeoutException:
+            self._logger.error("Timeout triggered when sending message to Discord")
+            return None
+        except httpx.TransportError:
+            self._logger.error(
+                "Transport error triggered when sending message to Discord"
+            )
+            return None
+        except httpx.HTTPError as error:
+            self._logger.error(
+                "Error triggered when sending message to Discord: {}".format(error)
+            )
+            return None
+
+        return self.check_response(response, message_id)
+
+    async def send_progress(self, message: Message):
+        message_id = self.progress_messages.get(message.event_id)
+        if message_id is not None:
+            payload, file = self.edit_payload(message)
+            response = await self.deliver(payload, file, message_id)
+            if not self.progress_deleted(message, response):
+                return response
+
+        payload, file = self.payload([message])
+        response = await self.deliver(payload, file, wait=True)
+        self.remember_progress(message, response)
+        return response
+
+    async def process(self, messages):
+        messages = self.sendable(messages)
+        if len(messages) == 0:
+            return
+
+        started = time.monotonic()
+        if len(messages) == 1 and self.editable(messages[0]):
+            response = await self.send_progress(messages[0])
+        else:
+            self.reset_progress(messages)
+            payload, file = self.payload(messages)
+            response = await self.deliver(payload, file)
+
+        await self.blocking(self.complete, messages, started, response)
+
+    async def collect(self, batch):
+        # Adds the messages queued during the batch window, as long as they fit.
+        # Messages are only handed out once their media is ready, so preparing
+        # them doesn't block the event loop.
+        for message in batch:
+            self.prepare(message)
+
+        deadline = time.monotonic() + self.batch_window
+        rejected = []
+
+        def accept(message):
+            if self.fits(batch, message):
+                return True
+
+            rejected.append(message)
+            return False
+
+        while time.monotonic() < deadline and len(rejected) == 0:
+            self.wakeup.clear()
+            message = self.queue.get(timeout=0, accept=accept)
+            if message is not None:
+                batch.append(message)
+            elif len(rejected) == 0:
+                await self.wait(deadline - time.monotonic())
+
+    async def work(self):
+        while not self.stopped:
+            for message in await self.blocking(lambda: list(self.outbox_due())):
+                await self.process([message])
+
+            self.wakeup.clear()
+            message: Message = self.queue.get(timeout=0)
+            if message is None:
+                await self.wait(await self.blocking(self.outbox_timeout))
+                continue
+
+            batch = [message]
+            try:
+                if self.batchable(message):
+                    started = time.monotonic()
+                    await self.collect(batch)
+                    self.batch_span(batch, started)
+
+                await self.process(list(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.queue.listener = self.notify
+
+        # An unexpected error must not stop the notifications until OctoPrint restarts
+        while not self.stopped:
+            try:
+                await self.work()
+            except Exception:
+                self._logger.exception("Discord sender failed, restarting it")
+                await asyncio.sleep(1)
+
+        self.queue.listener = None
+        await self.close_client()
+
+
+async def stream(encoder: MultipartEncoder):
+    # httpx only streams asynchronous bodies in an asynchronous client. The files are
+    # read in the default executor, not in the event loop.
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, encoder.read, CHUNK_SIZE_BYTES)
+        if not chunk:
+            break
+        yield chunk
@@ -3,12 +3,14 @@ EVENTS = {
     "startup": {
         "enabled": True,
         "media": "",
+        "priority": "normal",
         "message": "⏰ I just woke up! What are we gonna print today?",
         "variables": [],
     },
     "shutdown": {
         "enabled": True,
         "media": "",
+        "priority": "high",
         "message": "💤 Going to bed now!",
         "variables": [],
     },
@@ -16,18 +18,21 @@ EVENTS = {
     "printer_state_operational": {
         "enabled": True,
         "media": "",
+        "priority": "normal",
         "message": "✅ Your printer is operational.",
         "variables": [],
     },
     "printer_state_error": {
         "enabled": True,
         "media": "",
+        "priority": "high",
         "message": "⚠️ Your printer is in an erroneous state.",
         "variables": [],
     },
     "printer_state_unknown": {
         "enabled": True,
         "media": "",
+        "priority": "high",
         "message": "❔ Your printer is in an unknown state.",
         "variables": [],
     },
@@ -35,24 +40,28 @@ EVENTS = {
     "printing_started": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "normal",
         "message": "🖨️ I've started printing **{name}**",
         "variables": ["name", "path", "origin", "size", "owner", "user"],
     },
     "printing_paused": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "normal",
         "message": "⏸️ The printing was paused.",
         "variables": ["name", "path", "origin", "size", "owner", "user"],
     },
     "printing_resumed": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "normal",
         "message": "▶️ The printing was resumed.",
         "variables": ["name", "path", "origin", "size", "owner", "user"],
     },
     "printing_cancelled": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "high",
         "message": "🛑 The printing was stopped.",
         "variables": [
             "name",
@@ -68,6 +77,7 @@ EVENTS = {
     "printing_done": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "normal",
         "message": "👍 Printing is done! Took about {time_formatted}",
         "variables": [
             "name",
@@ -83,6 +93,7 @@ EVENTS = {
     "printing_failed": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "high",
         "message": "👎 Printing has failed! :(",
         "variables": ["time", "reason", "error"],
     },
@@ -90,18 +101,21 @@ EVENTS = {
     "transfer_started": {
         "enabled": False,
         "media": "thumbnail",
+        "priority": "normal",
         "message": "📼 Transfer started: {local} to {remote}",
         "variables": ["local", "remote"],
     },
     "transfer_done": {
         "enabled": False,
         "media": "",
+        "priority": "normal",
         "message": "📼 Transfer done in {time_formatted}",
         "variables": ["local", "remote", "time", "time_formatted"],
     },
     "transfer_failed": {
         "enabled": False,
         "media": "",
+        "priority": "high",
         "message": "📼 Transfer has failed! :(",
         "variables": ["local", "remote", "time"],
     },
@@ -109,6 +123,7 @@ EVENTS = {
     "printing_progress": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "low",
         "message": "📢 Printing is at {progress}%",
         "variables": [
             "name",
@@ -127,6 +142,7 @@ EVENTS = {
     "transfer_progress": {
         "enabled": False,
         "media": "",
+        "priority": "low",
         "message": "📼 Transfer is at {progress}%",
         "variables": ["progress"],
     },
@@ -134,12 +150,14 @@ EVENTS = {
     "timelapse_done": {
         "enabled": False,
         "media": "timelapse",
+        "priority": "normal",
         "message": "🎥 Timelapse has been created: {movie_basename}",
         "variables": ["gcode", "movie", "movie_basename", "movie_prefix"],
     },
     "timelapse_failed": {
         "enabled": False,
         "media": "",
+        "priority": "normal",
         "message": "🎥 Timelapse is not available",
         "variables": [
             "gcode",
@@ -156,6 +174,7 @@ EVENTS = {
     "test": {
         "enabled": True,
         "media": "snapshot",
+        "priority": "high",
         "message": "Hello hello! If you see this message, it means that the settings are correct!",
     },
 }
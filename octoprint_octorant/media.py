@@ -3,8 +3,19 @@
 import requests
 import os
 import base64
+import hashlib
+import glob
+import mmap
 import re
+import shutil
+import subprocess
 import sys
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Lock
 
 from octoprint.util.version import is_octoprint_compatible
 
@@ -14,21 +25,640 @@ if is_octoprint_compatible(">=1.9"):
 from PIL import Image
 from io import BytesIO
 
-GCODE_COMMENT_LINE_PREFIX = ";"
+from . import metrics
+from .config import Config
+from .multipart import upload_file
+from .transcode import transcode_timelapse
+
+GCODE_COMMENT_LINE_PREFIX = b";"
 MAX_THUMBNAIL_SIZE_BYTES = 8192 * 1024
 
-reThumbDelim = re.compile("^thumbnail (begin [0-9]+(?:x| )[0-9]+ ([0-9]+)|end)")
+# Thumbnails are searched in the first and last bytes of the GCode files only
+DEFAULT_HEADER_BUDGET_BYTES = 4 * 1024 * 1024
+DEFAULT_TAIL_BUDGET_BYTES = 1024 * 1024
+SCAN_CHUNK_SIZE_BYTES = 256 * 1024
+
+# The least recently used thumbnails on disk are removed above this size. Every file
+# counts for at least a disk block, so that the empty ones are bounded too.
+MAX_DISK_CACHE_BYTES = 64 * 1024 * 1024
+DISK_BLOCK_BYTES = 4096
+
+# Used for an unbounded side when resizing snapshots
+MAX_SNAPSHOT_SIDE = 65535
+
+# Single transpose equivalent to (flipH, flipV, rotate90), applied in that order
+SNAPSHOT_TRANSPOSE = {
+    (False, False, False): None,
+    (False, False, True): Image.ROTATE_90,
+    (False, True, False): Image.FLIP_TOP_BOTTOM,
+    (False, True, True): Image.TRANSVERSE,
+    (True, False, False): Image.FLIP_LEFT_RIGHT,
+    (True, False, True): Image.TRANSPOSE,
+    (True, True, False): Image.ROTATE_180,
+    (True, True, True): Image.ROTATE_270,
+}
+
+# Same operations for jpegtran, which rotates clockwise
+JPEGTRAN_ARGS = {
+    Image.ROTATE_90: ["-rotate", "270"],
+    Image.FLIP_TOP_BOTTOM: ["-flip", "vertical"],
+    Image.TRANSVERSE: ["-transverse"],
+    Image.FLIP_LEFT_RIGHT: ["-flip", "horizontal"],
+    Image.TRANSPOSE: ["-transpose"],
+    Image.ROTATE_180: ["-rotate", "180"],
+    Image.ROTATE_270: ["-rotate", "90"],
+}
+
+# Slicer thumbnail formats, and the output formats we can re-encode them to
+THUMBNAIL_FORMATS = {b"PNG": "png", b"JPG": "jpg", b"QOI": "qoi"}
+ENCODE_FORMATS = {"jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp")}
+
+reThumbDelim = re.compile(
+    rb"^thumbnail(?:_(PNG|JPG|QOI))? (begin ([0-9]+)(?:x| )([0-9]+) ([0-9]+)|end)"
+)
+reMotionCommand = re.compile(rb"^G[0-3](?![0-9])")
+
+
+# Keeps the thumbnails extracted from GCode files, so that a file is only scanned once.
+# Entries are keyed by path, size and modification time, kept in a bounded LRU in memory
+# and optionally stored in a folder on disk, itself bounded, and pruned when the GCode
+# file is removed or moved.
+class ThumbnailCache:
+    def __init__(self, logger, size=16, folder=None):
+        self.logger = logger
+        self.size = size
+        self.folder = folder
+
+        # Scanner options
+        self.headerBudget = DEFAULT_HEADER_BUDGET_BYTES
+        self.tailBudget = DEFAULT_TAIL_BUDGET_BYTES
+        self.useMmap = False
+
+        # Output options
+        self.targetWidth = 0
+        self.targetHeight = 0
+        self.encode = ""
+        self.quality = 85
+
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        # Only one scan at a time when warming the cache
+        self.warmer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="octorant-thumbnails"
+        )
+
+        if self.folder is not None and not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def set_config(self, size=16, folder=None):
+        with self.lock:
+            self.size = size
+            self.folder = folder
+            self.evict()
+
+        if self.folder is not None and not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def set_scan_config(
+        self,
+        headerBudget=DEFAULT_HEADER_BUDGET_BYTES,
+        tailBudget=DEFAULT_TAIL_BUDGET_BYTES,
+        useMmap=False,
+    ):
+        self.headerBudget = headerBudget
+        self.tailBudget = tailBudget
+        self.useMmap = useMmap
+
+    def set_output_config(self, targetWidth=0, targetHeight=0, encode="", quality=85):
+        self.targetWidth = targetWidth
+        self.targetHeight = targetHeight
+        self.encode = encode
+        self.quality = quality
+
+    def warm(self, filePath):
+        self.warmer.submit(self.get, filePath)
+
+    def forget(self, filePath):
+        # The GCode file is gone, so are its thumbnails
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == filePath]:
+                del self.entries[key]
+
+        if self.folder is None:
+            return
+
+        for path in glob.glob(self.disk_path((filePath,), allVersions=True)):
+            try:
+                os.remove(path)
+            except OSError:
+                self.logger.error(sys.exc_info())
+
+    def get(self, filePath):
+        try:
+            stat = os.stat(filePath)
+        except OSError:
+            self.logger.debug("Gcode file not found: {}".format(filePath))
+            return None
+
+        # Output options are part of the key, as they change the chosen thumbnail
+        key = (
+            filePath,
+            stat.st_size,
+            stat.st_mtime_ns,
+            self.targetWidth,
+            self.targetHeight,
+            self.encode,
+            self.quality,
+        )
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.logger.debug("Thumbnail found in cache: {}".format(filePath))
+                return self.entries[key]
+
+        # An empty tuple means that the file has no thumbnail
+        thumbnail = self.read_from_disk(key)
+        if thumbnail is None:
+            variants = extract_gcode_thumbnails(
+                filePath,
+                self.logger,
+                self.headerBudget,
+                self.tailBudget,
+                self.useMmap,
+            )
+            thumbnail = (
+                negotiate_thumbnail(
+                    variants,
+                    self.logger,
+                    self.targetWidth,
+                    self.targetHeight,
+                    self.encode,
+                    self.quality,
+                )
+                or ()
+            )
+            self.write_to_disk(key, thumbnail)
+
+        with self.lock:
+            self.entries[key] = thumbnail
+            self.evict()
+
+        return thumbnail
+
+    def evict(self):
+        while len(self.entries) > max(0, self.size):
+            self.entries.popitem(last=False)
+
+    def disk_path(self, key, extension="*", allVersions=False):
+        if self.folder is None:
+            return None
+
+        prefix = hashlib.sha1(key[0].encode("utf-8")).hexdigest()
+        if allVersions:
+            return os.path.join(self.folder, prefix + "-*")
+
+        options = hashlib.sha1(repr(key[3:]).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(
+            self.folder,
+            "{}-{}-{}-{}.{}".format(prefix, key[1], key[2], options, extension),
+        )
+
+    def read_from_disk(self, key):
+        if self.folder is None:
+            return None
+
+        for path in glob.glob(self.disk_path(key)):
+            try:
+                with open(path, "rb") as f:
+                    self.logger.debug("Thumbnail found on disk: {}".format(path))
+
+                    # Recently used, kept when the folder is pruned
+                    os.utime(path)
+                    extension = os.path.splitext(path)[1][1:]
+                    if extension == "none":
+                        return ()
+
+                    return ("thumbnail." + extension, f.read())
+            except OSError:
+                self.logger.error(sys.exc_info())
+
+        return None
+
+    def write_to_disk(self, key, thumbnail):
+        if self.folder is None:
+            return
+
+        try:
+            # Remove the thumbnails of previous versions of the same file
+            for old in glob.glob(self.disk_path(key, allVersions=True)):
+                os.remove(old)
+
+            if len(thumbnail) == 0:
+                path = self.disk_path(key, "none")
+                data = b""
+            else:
+                path = self.disk_path(key, os.path.splitext(thumbnail[0])[1][1:])
+                data = thumbnail[1]
+
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError:
+            self.logger.error(sys.exc_info())
+
+        self.prune_disk()
+
+    def prune_disk(self):
+        files = []
+        for path in glob.glob(os.path.join(self.folder, "*")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, max(stat.st_size, DISK_BLOCK_BYTES), path))
+
+        total = sum(size for _, size, _ in files)
+
+        # Least recently used first
+        for _, size, path in sorted(files):
+            if total <= MAX_DISK_CACHE_BYTES:
+                break
+
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                self.logger.error(sys.exc_info())
+
+
+def extract_gcode_thumbnails(
+    filePath,
+    logger,
+    headerBudget=DEFAULT_HEADER_BUDGET_BYTES,
+    tailBudget=DEFAULT_TAIL_BUDGET_BYTES,
+    useMmap=False,
+):
+    with open(filePath, "rb") as f:
+        fileSize = os.fstat(f.fileno()).st_size
+        if fileSize == 0:
+            return []
+
+        source = f
+        if useMmap:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            # Most slicers put the thumbnails in the header, before any move.
+            variants = parse_gcode_thumbnails(
+                iter_gcode_lines(source, 0, headerBudget, fileSize),
+                logger,
+                stopAtMotion=True,
+            )
+
+            # Some others append them at the very end of the file.
+            tailStart = max(0, fileSize - tailBudget)
+            if len(variants) == 0 and tailBudget > 0:
+                lines = iter_gcode_lines(source, tailStart, tailBudget, fileSize)
+                if tailStart > 0:
+                    # first line is most likely incomplete
+                    next(lines, None)
+
+                variants = parse_gcode_thumbnails(lines, logger, stopAtMotion=False)
+        finally:
+            if useMmap:
+                source.close()
+
+    if len(variants) == 0:
+        logger.debug("No thumbnail found")
+
+    return variants
+
+
+def iter_gcode_lines(source, start, budget, fileSize):
+    end = min(fileSize, start + budget)
+
+    if isinstance(source, mmap.mmap):
+        position = start
+        while position < end:
+            newline = source.find(b"\n", position, end)
+            if newline < 0:
+                # only yield the last line if it really is the end of the file
+                if end == fileSize:
+                    yield source[position:end]
+                return
+
+            yield source[position:newline]
+            position = newline + 1
+        return
+
+    source.seek(start)
+    remaining = end - start
+    pending = b""
+
+    while remaining > 0:
+        chunk = source.read(min(SCAN_CHUNK_SIZE_BYTES, remaining))
+        if not chunk:
+            break
+
+        remaining -= len(chunk)
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+
+    if pending and end == fileSize:
+        yield pending
+
+
+def parse_gcode_thumbnails(lines, logger, stopAtMotion=True):
+    # Every thumbnail found, still base64 encoded: only the chosen one is decoded
+    variants = []
+
+    current = None
+    currentFilled = 0
+
+    for line in lines:
+        line = line.strip()
+
+        if not line.startswith(GCODE_COMMENT_LINE_PREFIX):
+            if stopAtMotion and reMotionCommand.match(line):
+                # we hit first actions to the printer, better to stop now.
+                break
+
+            # skip lines that are not full-line comments
+            continue
+
+        # remove prefix and space chars
+        strippedLine = line[len(GCODE_COMMENT_LINE_PREFIX) :].strip()
+
+        match = reThumbDelim.match(strippedLine)
+        if match:
+            if match.group(2).startswith(b"begin"):
+                thumbnailSize = int(match.group(5))
+                current = None
+
+                if thumbnailSize > MAX_THUMBNAIL_SIZE_BYTES:
+                    logger.debug(
+                        "Found thumbnail of {} bytes, skip, bigger than threshold".format(
+                            thumbnailSize
+                        )
+                    )
+                    continue
+
+                # the announced size is the length of the base64 payload
+                current = {
+                    "format": THUMBNAIL_FORMATS[match.group(1) or b"PNG"],
+                    "width": int(match.group(3)),
+                    "height": int(match.group(4)),
+                    "data": bytearray(thumbnailSize),
+                }
+                currentFilled = 0
+
+                logger.debug(
+                    "Found {format} thumbnail of {width}x{height}".format(**current)
+                    + " ({} bytes)".format(thumbnailSize)
+                )
+
+            elif current is not None:
+                current["data"] = current["data"][:currentFilled]
+                variants.append(current)
+                current = None
+        elif current is not None:
+            end = currentFilled + len(strippedLine)
+            if end > len(current["data"]):
+                logger.debug("skip, thumbnail bigger than announced")
+                current = None
+                continue
+
+            current["data"][currentFilled:end] = strippedLine
+            currentFilled = end
+
+    return variants
+
+
+def negotiate_thumbnail(
+    variants, logger, targetWidth=0, targetHeight=0, encode="", quality=85
+):
+    Image.init()
+
+    # Drop the formats Pillow can't read (QOI needs Pillow 9.5+), as Discord
+    # can't display them either and they must be re-encoded.
+    candidates = [v for v in variants if v["format"] != "qoi" or "QOI" in Image.OPEN]
+
+    if len(candidates) == 0:
+        return None
+
+    # Smallest thumbnail meeting the target, or the biggest one if none does
+    bigEnough = [
+        v
+        for v in candidates
+        if v["width"] >= targetWidth and v["height"] >= targetHeight
+    ]
+    if len(bigEnough) > 0 and (targetWidth > 0 or targetHeight > 0):
+        chosen = min(
+            bigEnough, key=lambda v: (v["width"] * v["height"], len(v["data"]))
+        )
+    else:
+        chosen = max(
+            candidates, key=lambda v: (v["width"] * v["height"], len(v["data"]))
+        )
+
+    logger.debug("Chosen {format} thumbnail of {width}x{height}".format(**chosen))
+
+    try:
+        data = base64.b64decode(chosen["data"])
+    except ValueError:
+        logger.error(sys.exc_info())
+        return None
+
+    if encode not in ENCODE_FORMATS and chosen["format"] != "qoi":
+        return ("thumbnail." + chosen["format"], data)
+
+    # Re-encode to a compact format, QOI always goes to PNG at least
+    pillowFormat, extension = ENCODE_FORMATS.get(encode, ("PNG", "png"))
+
+    try:
+        img = Image.open(BytesIO(data))
+
+        if targetWidth > 0 and targetHeight > 0:
+            img.thumbnail((targetWidth, targetHeight))
+
+        if pillowFormat == "JPEG" and img.mode != "RGB":
+            # JPEG has no transparency, put the thumbnail on a white background
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+
+        output = BytesIO()
+        img.save(output, pillowFormat, quality=quality)
+    except Exception:
+        logger.error(sys.exc_info())
+        if chosen["format"] == "qoi":
+            return None
+
+        return ("thumbnail." + chosen["format"], data)
+
+    logger.debug(
+        "Thumbnail re-encoded to {}: {} -> {} bytes".format(
+            pillowFormat, len(data), output.tell()
+        )
+    )
+
+    # Tiny thumbnails are sometimes already smaller than what we can do
+    if output.tell() >= len(data) and chosen["format"] != "qoi":
+        return ("thumbnail." + chosen["format"], data)
+
+    return ("thumbnail." + extension, output.getvalue())
+
+
+# Shares webcam snapshots between notifications fired within a few seconds. Concurrent
+# requests for the same snapshot wait for the capture already in flight instead of
+# hitting the camera again, at most until the timeout.
+class SnapshotCache:
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+        self.inflight = {}
+
+    def get(self, key, ttl, capture, timeout=None):
+        if ttl <= 0:
+            return capture()
+
+        with self.lock:
+            now = time.monotonic()
+
+            # forget everything that has expired
+            for expiredKey in [k for k, e in self.entries.items() if e[0] <= now]:
+                del self.entries[expiredKey]
+
+            if key in self.entries:
+                return self.entries[key][1]
+
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[key] = future
+
+        if not owner:
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                # Give up on this capture, the next request will start a new one
+                with self.lock:
+                    if self.inflight.get(key) is future:
+                        del self.inflight[key]
+                return None
+
+        try:
+            snapshot = capture()
+        except BaseException as error:
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+            future.set_exception(error)
+            raise
+
+        with self.lock:
+            # failed captures are shared with the waiters, but not kept, nor the
+            # captures given up by a waiter
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+                if snapshot is not None:
+                    self.entries[key] = (time.monotonic() + ttl, snapshot)
+
+        future.set_result(snapshot)
+        return snapshot
+
+
+snapshotCache = SnapshotCache()
+
+
+def transform_snapshot(
+    image, logger, transpose=None, maxWidth=0, maxHeight=0, quality=75, lossless=True
+):
+    resize = maxWidth > 0 or maxHeight > 0
+
+    # Only call Pillow if we need to transform anything
+    if transpose is None and not resize:
+        return image
+
+    logger.debug(
+        "Transformations on snapshot: transpose={}, max size={}x{}".format(
+            transpose, maxWidth, maxHeight
+        )
+    )
+
+    # Flipping and rotating can be done without decoding the JPEG at all
+    if not resize and lossless:
+        transformed = jpegtran_transform(image, logger, transpose)
+        if transformed is not None:
+            return transformed
+
+    try:
+        img = Image.open(BytesIO(image))
+
+        if resize:
+            # The size limits apply to the image once rotated
+            box = (maxWidth or MAX_SNAPSHOT_SIDE, maxHeight or MAX_SNAPSHOT_SIDE)
+            if transpose in [
+                Image.ROTATE_90,
+                Image.ROTATE_270,
+                Image.TRANSPOSE,
+                Image.TRANSVERSE,
+            ]:
+                box = (box[1], box[0])
+
+            # Let the JPEG decoder downscale big frames while decoding
+            img.draft("RGB", box)
+            img.thumbnail(box)
+
+        if transpose is not None:
+            img = img.transpose(transpose)
+
+        newImage = BytesIO()
+        img.save(newImage, "jpeg", quality=quality)
+
+        return newImage.getvalue()
+    except:
+        logger.error(sys.exc_info())
+
+    return image
+
+
+def jpegtran_transform(image, logger, transpose):
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None or image[:2] != b"\xff\xd8":
+        return None
+
+    try:
+        # -trim drops the partial blocks on the edges that can't be transformed
+        result = subprocess.run(
+            [jpegtran, "-copy", "none", "-trim"] + JPEGTRAN_ARGS[transpose],
+            input=image,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=10,
+            check=True,
+        )
+    except (OSError, subprocess.SubprocessError):
+        logger.debug("jpegtran failed, using Pillow: {}".format(sys.exc_info()[1]))
+        return None
+
+    return result.stdout or None
 
 
 class Media:
-    def __init__(self, settings, logger):
-        self.settings = settings
+    def __init__(self, config: Config, logger):
+        self.config = config
         self.logger = logger
 
         self.type = None
 
         # For gcode thumbnail and timelapses
         self.filePath = ""
+        self.thumbnailCache: ThumbnailCache = None
 
         # For snapshot
         self.url = ""
@@ -36,13 +666,18 @@ class Media:
         self.mustFlipV = False
         self.mustRotate = False
 
-        # For timelapse
+        # For timelapse, and the folder of its smaller copies
         self.maxAcceptedSize = 0
+        self.cacheFolder = None
+
+        # Time needed to get the media, when it's more than the usual media timeout
+        self.timeout = 0
 
-    def set_thumbnail(self, filePath):
+    def set_thumbnail(self, filePath, cache: ThumbnailCache = None):
         self.logger.debug("Media is thumbnail: {}".format(filePath))
         self.type = "thumbnail"
         self.filePath = filePath
+        self.thumbnailCache = cache
 
     def set_snapshot(self, url="", mustFlipH=False, mustFlipV=False, mustRotate=False):
         self.logger.debug("Media is snapshot: {}".format(url))
@@ -54,79 +689,64 @@ class Media:
             self.mustFlipV = mustFlipV
             self.mustRotate = mustRotate
 
-    def set_timelapse(self, filePath, maxAcceptedSize=0):
+    def set_timelapse(self, filePath, maxAcceptedSize=0, cacheFolder=None):
         self.logger.debug("Media is timelapse: {}".format(filePath))
         self.type = "timelapse"
         self.filePath = filePath
         self.maxAcceptedSize = maxAcceptedSize
+        self.cacheFolder = cacheFolder
+
+        if self.config.timelapse_transcode:
+            self.timeout = self.config.timelapse_transcode_timeout
 
     def get(self):
-        if self.type == "thumbnail":
-            return self.__grab_gcode_thumbnail()
-        elif self.type == "snapshot":
-            return self.__grab_snapshot()
-        elif self.type == "timelapse":
-            return self.__grab_file()
+        started = time.monotonic()
+        try:
+            if self.type == "thumbnail":
+                return self.__grab_gcode_thumbnail()
+            elif self.type == "snapshot":
+                return self.__grab_snapshot()
+            elif self.type == "timelapse":
+                return self.__grab_file()
 
-        return None
+            return None
+        finally:
+            metrics.media_duration.observe(
+                time.monotonic() - started, type=str(self.type)
+            )
 
     def __grab_gcode_thumbnail(self):
-        thumbnailB64 = ""
-        thumbnailBegan = False
-        thumbnailLastSize = -1
-
-        if os.path.exists(self.filePath) is False:
+        if self.thumbnailCache is not None:
+            thumbnail = self.thumbnailCache.get(self.filePath)
+        elif os.path.exists(self.filePath):
+            thumbnail = negotiate_thumbnail(
+                extract_gcode_thumbnails(self.filePath, self.logger), self.logger
+            )
+        else:
             self.logger.debug("Gcode file not found: {}".format(self.filePath))
-            return None
-
-        with open(self.filePath, "r") as f:
-            for line in f:
-                if not line.startswith(GCODE_COMMENT_LINE_PREFIX):
-                    # skip lines that are not full-line comments
-                    continue
+            thumbnail = None
 
-                if line.startswith("G1"):
-                    # we hit first actions to the printer, better to stop now.
-                    break
+        if thumbnail:
+            return {"file": thumbnail}
 
-                # remove prefix and space/newline chars
-                strippedLine = line[len(GCODE_COMMENT_LINE_PREFIX) :].strip()
-
-                match = reThumbDelim.match(strippedLine)
-                if match:
-                    if match.group(1).startswith("begin"):
-                        thumbnailSize = int(match.group(2))
-                        self.logger.debug(
-                            "Found thumbnail of {} bytes".format(thumbnailSize)
-                        )
-
-                        if thumbnailSize > MAX_THUMBNAIL_SIZE_BYTES:
-                            self.logger.debug("skip, bigger than threshold")
-                            thumbnailBegan = False
-                            thumbnailB64 = ""
-                        elif thumbnailSize > thumbnailLastSize:
-                            thumbnailBegan = True
-                            thumbnailLastSize = thumbnailSize
-                            thumbnailB64 = ""
-                        else:
-                            self.logger.debug("skip, already got one bigger")
-                            thumbnailBegan = False
-                            thumbnailB64 = ""
-                            continue
-
-                    elif match.group(1).startswith("end"):
-                        thumbnailBegan = False
-                else:
-                    if thumbnailBegan:
-                        thumbnailB64 += strippedLine
-
-        if len(thumbnailB64) > 0:
-            return {"file": ("thumbnail.png", base64.b64decode(thumbnailB64))}
-
-        self.logger.debug("No thumbnail found")
         return None
 
     def __grab_snapshot(self):
+        options = (
+            self.config.snapshot_max_width,
+            self.config.snapshot_max_height,
+            self.config.snapshot_quality,
+            self.config.snapshot_lossless_transform,
+        )
+
+        return snapshotCache.get(
+            (self.url, self.mustFlipH, self.mustFlipV, self.mustRotate) + options,
+            self.config.snapshot_cache_ttl,
+            lambda: self.__capture_snapshot(*options),
+            self.config.media_timeout or None,
+        )
+
+    def __capture_snapshot(self, maxWidth, maxHeight, quality, lossless):
         # output variable
         snapshot = None
         snapshotImage = None
@@ -147,11 +767,13 @@ class Media:
         else:
             # request a snapshot from the URL
             try:
-                snapshotCall = requests.get(self.url, stream=True)
+                snapshotCall = requests.get(
+                    self.url, stream=True, timeout=self.config.media_timeout or None
+                )
                 snapshotImage = BytesIO(snapshotCall.content)
-            except requests.ConnectTimeout:
+            except requests.Timeout:
                 snapshotImage = None
-                self.logger.error("Error while fetching snapshot: ConnectTimeout")
+                self.logger.error("Error while fetching snapshot: Timeout")
             except requests.ConnectionError:
                 snapshotImage = None
                 self.logger.error("Error while fetching snapshot: ConnectTimeout")
@@ -160,60 +782,60 @@ class Media:
             self.logger.error("Snapshot is empty")
             return None
 
-        # Only call Pillow if we need to transpose anything
-        if self.mustFlipH or self.mustFlipV or self.mustRotate:
-            self.logger.debug(
-                "Transformations on snapshot :"
-                + "FlipH={}, FlipV={} Rotate={}".format(
-                    self.mustFlipH, self.mustFlipV, self.mustRotate
-                )
-            )
-
-            try:
-                img = Image.open(snapshotImage)
-
-                if self.mustFlipH:
-                    img = img.transpose(Image.FLIP_LEFT_RIGHT)
-
-                if self.mustFlipV:
-                    img = img.transpose(Image.FLIP_TOP_BOTTOM)
-
-                if self.mustRotate:
-                    img = img.transpose(Image.ROTATE_90)
-
-                newImage = BytesIO()
-                img.save(newImage, "jpeg")
-
-                snapshotImage = newImage.getvalue()
-            except:
-                self.logger.error(sys.exc_info())
-
-            finally:
-                if len(snapshotImage) == 0:
-                    self.logger.error("Snapshot result is empty")
-                    return None
+        snapshotImage = transform_snapshot(
+            snapshotImage.getvalue(),
+            self.logger,
+            SNAPSHOT_TRANSPOSE[
+                (bool(self.mustFlipH), bool(self.mustFlipV), bool(self.mustRotate))
+            ],
+            maxWidth,
+            maxHeight,
+            quality,
+            lossless,
+        )
+
+        if snapshotImage is None or len(snapshotImage) == 0:
+            self.logger.error("Snapshot result is empty")
+            return None
 
         snapshot = {"file": ("snapshot.jpg", snapshotImage)}
 
         return snapshot
 
     def __grab_file(self):
-        if os.path.exists(self.filePath) is False:
+        # The file is streamed from the disk when the message is sent
+        upload = upload_file(self.filePath)
+        if upload is None:
             self.logger.debug("Media not found: {}".format(self.filePath))
             return None
 
-        if os.stat(self.filePath).st_size <= 0:
+        if upload.size <= 0:
             self.logger.debug("Media seems empty")
             return None
 
-        if (
-            self.maxAcceptedSize > 0
-            and os.stat(self.filePath).st_size > self.maxAcceptedSize
-        ):
-            self.logger.debug("Media bigger than max allowed size")
+        if self.maxAcceptedSize > 0 and upload.size > self.maxAcceptedSize:
+            if self.config.timelapse_transcode:
+                transcoded = transcode_timelapse(
+                    self.filePath,
+                    self.maxAcceptedSize,
+                    self.logger,
+                    self.config.webcam_ffmpeg,
+                    self.config.timelapse_transcode_timeout,
+                    self.config.timelapse_min_bitrate,
+                    self.config.timelapse_fallback,
+                    self.cacheFolder,
+                )
+                if transcoded is not None:
+                    fileName, transcodedPath = transcoded
+                    transcodedUpload = upload_file(transcodedPath)
+                    if transcodedUpload is not None:
+                        return {"file": (fileName, transcodedUpload)}
+
+            self.logger.warning(
+                "Media is {} bytes, more than the upload limit of {} bytes".format(
+                    upload.size, self.maxAcceptedSize
+                )
+            )
             return None
 
-        with open(self.filePath, "rb") as f:
-            return {"file": (os.path.basename(self.filePath), f.read())}
-
-        return None
+        return {"file": (os.path.basename(self.filePath), upload)}
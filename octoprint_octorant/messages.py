@@ -0,0 +1,90 @@
+# coding=utf-8
+
+# Message templates, parsed once when the settings are loaded instead of on every event.
+
+import re
+import string
+
+formatter = string.Formatter()
+
+# "name.attribute" and "name[key]" both need the "name" variable
+reFieldRoot = re.compile(r"^[^.\[]*")
+
+
+class MessageTemplate:
+    def __init__(self, template: str) -> None:
+        self.template = template
+
+        # (literal text, field name, format spec, conversion), as given by Formatter.parse
+        self.parts = []
+
+        # Every variable used by the template
+        self.fields = frozenset()
+
+        # Set when the template itself can't be parsed (e.g. unbalanced braces)
+        self.error = None
+
+        fields = set()
+        try:
+            for literal, field, spec, conversion in formatter.parse(template):
+                if field is not None:
+                    fields.add(reFieldRoot.match(field).group(0))
+                    if spec is not None and "{" in spec:
+                        # nested fields in the format spec, e.g. {progress:>{width}}
+                        for _, nested, _, _ in formatter.parse(spec):
+                            if nested is not None:
+                                fields.add(reFieldRoot.match(nested).group(0))
+
+                self.parts.append((literal, field, spec, conversion))
+        except ValueError as error:
+            self.error = str(error)
+
+        self.fields = frozenset(fields)
+
+    def uses(self, *variables):
+        return any(variable in self.fields for variable in variables)
+
+    def unknown(self, available):
+        return sorted(self.fields.difference(available))
+
+    def render(self, data) -> str:
+        if self.error is not None:
+            return (
+                self.template
+                + "\r\n:sos: **OctoRant Error**: invalid message: {}.".format(
+                    self.error
+                )
+            )
+
+        # Detected some tags that are not found in the payload
+        unknown = self.unknown(data)
+        if len(unknown) > 0:
+            return (
+                self.template
+                + "\r\n:sos: **OctoRant Error**: unknown variable{} {}.".format(
+                    "s" if len(unknown) > 1 else "",
+                    ", ".join("`{" + field + "}`" for field in unknown),
+                )
+            )
+
+        try:
+            message = []
+            for literal, field, spec, conversion in self.parts:
+                message.append(literal)
+
+                if field is None:
+                    continue
+
+                value, _ = formatter.get_field(field, (), data)
+                value = formatter.convert_field(value, conversion)
+
+                if spec and "{" in spec:
+                    spec = formatter.vformat(spec, (), data)
+
+                message.append(formatter.format_field(value, spec or ""))
+
+            return "".join(message)
+        except (LookupError, AttributeError, TypeError, ValueError) as error:
+            return self.template + "\r\n:sos: **OctoRant Error**: {}.".format(
+                error.args[0] if len(error.args) > 0 else type(error).__name__
+            )
@@ -0,0 +1,202 @@
+# coding: utf-8
+
+# Counters and histograms of the notification pipeline, in the Prometheus text format.
+#
+# They are served by the plugin on /plugin/octorant/metrics (with an API key), e.g. for
+# Prometheus:
+#
+#   - job_name: octorant
+#     metrics_path: /plugin/octorant/metrics
+#     params: {apikey: [...]}
+#     static_configs: [{targets: ["octopi.local"]}]
+
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    def __init__(self, kind, name, help) -> None:
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+
+        # label values (sorted tuple of (name, value)) -> value
+        self.values = {}
+
+    def samples(self):
+        # (suffix, labels, value) of every sample
+        with self.lock:
+            return [("", labels, value) for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    def __init__(self, name, help) -> None:
+        Metric.__init__(self, "counter", name, help)
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # Read when the metrics are rendered, from a function returning {labels: value}
+    def __init__(self, name, help, collect) -> None:
+        Metric.__init__(self, "gauge", name, help)
+        self.collect = collect
+
+    def samples(self):
+        return [
+            ("", label_key(dict(labels)), value)
+            for labels, value in self.collect().items()
+        ]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS) -> None:
+        Metric.__init__(self, "histogram", name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            # (cumulative count of each bucket, sum, count)
+            buckets, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            buckets = [
+                observations + (1 if value <= bound else 0)
+                for observations, bound in zip(buckets, self.buckets)
+            ]
+            self.values[key] = (buckets, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (buckets, total, count) in self.values.items():
+                for bound, observations in zip(self.buckets, buckets):
+                    samples.append(
+                        (
+                            "_bucket",
+                            labels + (("le", format_value(bound)),),
+                            observations,
+                        )
+                    )
+                samples.append(("_bucket", labels + (("le", "+Inf"),), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+
+        return samples
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, collect):
+        return self.register(Gauge(name, help, collect))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append(
+                    "{}{}{} {}".format(
+                        metric.name, suffix, format_labels(labels), format_value(value)
+                    )
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                name,
+                value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+            )
+            for name, value in labels
+        )
+        + "}"
+    )
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+registry = Metrics()
+
+# Notification pipeline, from the event to Discord
+on_event_duration = registry.histogram(
+    "octorant_on_event_seconds",
+    "Time spent in the event handlers called by OctoPrint",
+    (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05),
+)
+event_queue_wait = registry.histogram(
+    "octorant_event_queue_seconds", "Time spent by the events before being handled"
+)
+events = registry.counter("octorant_events_total", "Notified events, by event")
+settings_snapshots = registry.counter(
+    "octorant_settings_snapshots_total", "Snapshots of the settings built, by reason"
+)
+messages_queued = registry.counter(
+    "octorant_messages_queued_total", "Messages added to the send queue"
+)
+messages_sent = registry.counter(
+    "octorant_messages_sent_total", "Messages accepted by Discord"
+)
+messages_dropped = registry.counter(
+    "octorant_messages_dropped_total", "Messages not delivered, by reason"
+)
+queue_wait = registry.histogram(
+    "octorant_queue_wait_seconds", "Time spent by the messages in the send queue"
+)
+media_duration = registry.histogram(
+    "octorant_media_seconds", "Time to capture and encode the media, by type"
+)
+script_duration = registry.histogram(
+    "octorant_script_seconds", "Duration of the before/after scripts"
+)
+
+# HTTP requests to Discord
+http_duration = registry.histogram(
+    "octorant_http_request_seconds", "Duration of the requests to Discord"
+)
+http_responses = registry.counter(
+    "octorant_http_responses_total", "Responses of Discord, by status code"
+)
+rate_limit_wait = registry.counter(
+    "octorant_rate_limit_wait_seconds_total", "Time spent waiting for rate limits"
+)
+upload_bytes = registry.counter("octorant_upload_bytes_total", "Bytes sent to Discord")
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+# Streaming multipart/form-data encoder.
+#
+# requests builds the whole multipart body in memory before sending it, on top of the
+# file already read in memory. For timelapses, which can weigh hundreds of megabytes on
+# a Raspberry Pi with 512MB of RAM, the body is instead generated chunk by chunk while
+# it is sent, straight from the file on disk.
+
+import os
+import uuid
+
+CHUNK_SIZE_BYTES = 64 * 1024
+
+
+class UploadFile:
+    # A file sent from the disk, with the size it had when it was checked
+    def __init__(self, path, size) -> None:
+        self.path = path
+        self.size = size
+
+
+class MultipartEncoder:
+    def __init__(self, fields, files) -> None:
+        # fields: {name: value}, files: {name: (filename, bytes or UploadFile)}
+        self.fields = fields or {}
+        self.files = files or {}
+
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+
+        self.length = sum(len(header) + size + 2 for header, _, size in self.parts())
+        self.length += len(self.closing())
+
+        self.rewind()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.chunks()
+
+    def rewind(self):
+        # Starts over, e.g. when the request is sent again on a new connection
+        self.iterator = self.chunks()
+        self.buffer = b""
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.iterator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def parts(self):
+        # (headers, content, content size) of every part
+        for name, value in self.fields.items():
+            value = str(value).encode("utf-8")
+            yield (
+                self.header(
+                    'Content-Disposition: form-data; name="{}"'.format(quote(name))
+                ),
+                value,
+                len(value),
+            )
+
+        for name, (filename, content) in self.files.items():
+            header = self.header(
+                'Content-Disposition: form-data; name="{}"; filename="{}"'.format(
+                    quote(name), quote(filename)
+                ),
+                "Content-Type: application/octet-stream",
+            )
+
+            if isinstance(content, UploadFile):
+                yield (header, content, content.size)
+            else:
+                yield (header, content, len(content))
+
+    def header(self, *lines):
+        return "--{}\r\n{}\r\n\r\n".format(self.boundary, "\r\n".join(lines)).encode(
+            "utf-8"
+        )
+
+    def closing(self):
+        return "--{}--\r\n".format(self.boundary).encode("utf-8")
+
+    def chunks(self):
+        for header, content, size in self.parts():
+            yield header
+
+            if isinstance(content, UploadFile):
+                yield from read_file(content.path, size)
+            else:
+                yield content
+
+            yield b"\r\n"
+
+        yield self.closing()
+
+
+def read_file(path, size):
+    # Exactly `size` bytes, as announced in the Content-Length
+    remaining = size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE_BYTES, remaining))
+            if len(chunk) == 0:
+                raise IOError("{} was truncated while being sent".format(path))
+
+            remaining -= len(chunk)
+            yield chunk
+
+
+def has_upload_file(files):
+    return files is not None and any(
+        isinstance(content, UploadFile) for _, content in files.values()
+    )
+
+
+def quote(value):
+    return str(value).replace('"', "%22")
+
+
+def upload_file(path):
+    # None when the file doesn't exist anymore
+    try:
+        return UploadFile(path, os.stat(path).st_size)
+    except OSError:
+        return None
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+# Persistent outbox for the messages that couldn't be delivered to Discord.
+#
+# When a message fails because of the network (or a Discord server error), it is stored
+# in a small SQLite database in the plugin data folder, with the media that was grabbed
+# for it. The sender retries it later with an exponential backoff, including after a
+# restart of OctoPrint.
+
+import os
+import random
+import sqlite3
+import time
+
+from threading import Lock
+
+from .multipart import UploadFile, upload_file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    event_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    file_name TEXT,
+    file_data BLOB,
+    file_path TEXT
+)
+"""
+
+
+class OutboxEntry:
+    def __init__(self, row) -> None:
+        (
+            self.id,
+            self.created,
+            self.event_id,
+            self.content,
+            self.priority,
+            self.attempts,
+            self.next_attempt,
+            file_name,
+            file_data,
+            file_path,
+        ) = row
+
+        self.file = None
+        if file_path is not None:
+            # Big files (timelapses) are sent again from their original location
+            upload = upload_file(file_path)
+            if upload is not None:
+                self.file = {"file": (file_name, upload)}
+        elif file_name is not None:
+            self.file = {"file": (file_name, file_data)}
+
+
+class Outbox:
+    def __init__(self, logger, path, base_delay=5, max_delay=900, max_attempts=10):
+        self._logger = logger
+
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.lock = Lock()
+
+        folder = os.path.dirname(path)
+        if folder != "" and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(SCHEMA)
+
+    def backoff(self, attempts):
+        # Exponential backoff, with half of it randomized so that messages queued
+        # during the same outage don't all come back at the same time.
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def postpone(self, entry_id, event_id, content, priority, file, attempts):
+        # Returns the id of the entry, or None when the message is given up
+        if attempts >= self.max_attempts:
+            self._logger.error(
+                "Giving up on {} message after {} attempts".format(event_id, attempts)
+            )
+            if entry_id is not None:
+                self.remove(entry_id)
+            return None
+
+        next_attempt = time.time() + self.backoff(attempts)
+
+        with self.lock, self.db:
+            if entry_id is not None:
+                self.db.execute(
+                    "UPDATE messages SET attempts = ?, next_attempt = ? WHERE id = ?",
+                    (attempts, next_attempt, entry_id),
+                )
+            else:
+                file_name, file_data, file_path = None, None, None
+                if file is not None and "file" in file:
+                    file_name, file_data = file["file"]
+                    if isinstance(file_data, UploadFile):
+                        file_path, file_data = file_data.path, None
+
+                cursor = self.db.execute(
+                    "INSERT INTO messages (created, event_id, content, priority, attempts, next_attempt, file_name, file_data, file_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        time.time(),
+                        event_id,
+                        content,
+                        priority,
+                        attempts,
+                        next_attempt,
+                        file_name,
+                        file_data,
+                        file_path,
+                    ),
+                )
+                entry_id = cursor.lastrowid
+
+        self._logger.info(
+            "Message {} stored in the outbox, next attempt in {:.0f}s".format(
+                event_id, next_attempt - time.time()
+            )
+        )
+        return entry_id
+
+    def remove(self, entry_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE id = ?", (entry_id,))
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def next_due(self):
+        # Time of the next attempt, or None when the outbox is empty
+        with self.lock:
+            row = self.db.execute("SELECT MIN(next_attempt) FROM messages").fetchone()
+
+        return row[0] if row is not None else None
+
+    def due(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, created, event_id, content, priority, attempts, next_attempt, file_name, file_data, file_path FROM messages WHERE next_attempt <= ? ORDER BY created",
+                (time.time(),),
+            ).fetchall()
+
+        return [OutboxEntry(row) for row in rows]
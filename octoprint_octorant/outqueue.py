@@ -0,0 +1,193 @@
+# coding: utf-8
+
+# Outbound queue of the Discord sender.
+#
+# Messages are sent by priority class ("high", "normal", "low"), in the order they were
+# queued within a class. To avoid starvation, a message gains one class every `aging`
+# seconds it has been waiting, so a steady flow of errors can't block progress updates
+# forever.
+#
+# A message is only handed out once its media is ready (or at the media timeout). While
+# a snapshot or a thumbnail is being grabbed, the messages queued behind it wait, so they
+# are still sent in order. Messages waiting for a long media, like a timelapse being
+# transcoded, are skipped instead until it is ready, so they don't hold the others.
+#
+# Messages with the same coalesce key replace each other: only the latest one is kept.
+#
+# The queue is bounded. When it is full, the oldest message of the lowest priority class
+# is dropped to make room for the new one. If the new message has a lower priority than
+# everything already queued, the new message is dropped instead.
+
+import itertools
+import time
+
+from threading import Condition
+from . import metrics
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+
+
+class OutboundQueue:
+    def __init__(self, logger, capacity=100, aging=30, name="default"):
+        self._logger = logger
+
+        # Webhook of the queue, for the metrics
+        self.name = name
+
+        self.capacity = capacity
+        self.aging = aging
+
+        self.condition = Condition()
+        self.items = []
+        self.sequence = itertools.count()
+        self.unfinished = 0
+        self.woken = False
+
+        # Called when a message is added or the queue is woken up, for the senders
+        # that don't wait in get()
+        self.listener = None
+
+    def set_config(self, capacity=100, aging=30):
+        with self.condition:
+            self.capacity = capacity
+            self.aging = aging
+
+    def qsize(self):
+        with self.condition:
+            return len(self.items)
+
+    def put(self, message):
+        with self.condition:
+            message.priority_class = PRIORITIES.get(
+                message.priority, PRIORITIES[DEFAULT_PRIORITY]
+            )
+            message.queued_at = time.monotonic()
+            message.sequence = next(self.sequence)
+
+            if message.coalesce_key is not None:
+                for queued in [
+                    m for m in self.items if m.coalesce_key == message.coalesce_key
+                ]:
+                    self._logger.debug(
+                        "Message superseded by a newer {}: {}".format(
+                            queued.event_id, queued.content
+                        )
+                    )
+                    self.discard(queued, "superseded")
+
+            if self.capacity > 0 and len(self.items) >= self.capacity:
+                # oldest message of the lowest priority class
+                victim = max(self.items, key=lambda m: (m.priority_class, -m.sequence))
+                if victim.priority_class < message.priority_class:
+                    victim = message
+
+                self._logger.warning(
+                    "Queue is full ({} messages), dropping {}: {}".format(
+                        len(self.items), victim.event_id, victim.content
+                    )
+                )
+                if victim is message:
+                    message.cancel()
+                    metrics.messages_dropped.inc(webhook=self.name, reason="queue_full")
+                    message.finish(self.name, "queue_full")
+                    return False
+
+                self.discard(victim, "queue_full")
+
+            self.items.append(message)
+            self.unfinished += 1
+            metrics.messages_queued.inc(webhook=self.name)
+            self.condition.notify_all()
+
+        self.notify()
+        return True
+
+    def get(self, timeout=None, accept=None):
+        # Returns None after the timeout, or when woken up with nothing to send.
+        # With accept, the next message is only taken when accept(message) is true.
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                ready = [m for m in self.items if not m.transcoding()]
+                message = min(ready, key=self.rank) if len(ready) > 0 else None
+                if message is not None and not message.pending():
+                    if accept is not None and not accept(message):
+                        return None
+
+                    self.items.remove(message)
+                    waited = time.monotonic() - message.queued_at
+                    metrics.queue_wait.observe(waited, webhook=self.name)
+                    message.span("queue", message.queued_at, waited, webhook=self.name)
+                    return message
+
+                if self.woken:
+                    self.woken = False
+                    return None
+
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        return None
+
+                self.condition.wait(self.media_wait(wait))
+
+    def media_wait(self, wait=None):
+        # A message waiting for its media is ready at the media timeout anyway. The
+        # other messages are ready already, or wait for the one before them.
+        with self.condition:
+            for m in self.items:
+                if not m.pending():
+                    continue
+
+                until = max(0, m.media_deadline - time.time())
+                wait = until if wait is None else min(wait, until)
+
+        return wait
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+        self.notify()
+
+    def notify(self):
+        listener = self.listener
+        if listener is not None:
+            listener()
+
+    def rank(self, message):
+        priority_class = message.priority_class
+        if self.aging > 0:
+            waited = time.monotonic() - message.queued_at
+            priority_class -= int(waited // self.aging)
+
+        return (priority_class, message.sequence)
+
+    def discard_event(self, event_id):
+        with self.condition:
+            for message in [m for m in self.items if m.event_id == event_id]:
+                self.discard(message, "superseded")
+
+    def discard(self, message, reason):
+        # Only for messages still in the queue
+        self.items.remove(message)
+        message.cancel()
+        metrics.messages_dropped.inc(webhook=self.name, reason=reason)
+        message.finish(self.name, reason)
+        self.task_done()
+
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.unfinished = 0
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.unfinished > 0:
+                self.condition.wait()
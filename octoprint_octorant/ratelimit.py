@@ -0,0 +1,84 @@
+# coding: utf-8
+
+# Keeps track of Discord's rate limits, as announced in the headers of every response.
+#
+# See https://discord.com/developers/docs/topics/rate-limits: every route belongs to a
+# bucket, and each response tells how many requests are left in that bucket and when it
+# resets. Senders ask for the delay before their next request, so that they wait instead
+# of hitting a 429.
+
+import time
+
+from threading import Lock
+
+
+class RateLimiter:
+    def __init__(self):
+        self.lock = Lock()
+
+        # route -> bucket id, as routes sharing a bucket share its limits
+        self.routes = {}
+
+        # bucket id -> (remaining requests, monotonic time of the reset)
+        self.buckets = {}
+
+        # Global rate limit, for all the routes
+        self.global_until = 0
+
+    def delay(self, route) -> float:
+        now = time.monotonic()
+
+        with self.lock:
+            delay = self.global_until - now
+
+            bucket = self.buckets.get(self.routes.get(route, route))
+            if bucket is not None:
+                remaining, reset_at = bucket
+                if reset_at <= now:
+                    # the bucket has been reset since
+                    del self.buckets[self.routes.get(route, route)]
+                elif remaining <= 0:
+                    delay = max(delay, reset_at - now)
+
+        return max(0, delay)
+
+    def update(self, route, status_code, headers, body=None) -> float:
+        # Returns the time to wait before retrying, when rate limited
+        now = time.monotonic()
+        retry_after = 0
+
+        with self.lock:
+            bucket_id = headers.get("X-RateLimit-Bucket")
+            if bucket_id is not None:
+                self.routes[route] = bucket_id
+            else:
+                bucket_id = self.routes.get(route, route)
+
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset_after = headers.get("X-RateLimit-Reset-After")
+            if remaining is not None and reset_after is not None:
+                try:
+                    self.buckets[bucket_id] = (
+                        int(remaining),
+                        now + float(reset_after),
+                    )
+                except ValueError:
+                    pass
+
+            if status_code == 429:
+                # retry_after is in seconds (with decimals) in the current API
+                try:
+                    retry_after = float(
+                        (body or {}).get("retry_after", headers.get("Retry-After", 1))
+                    )
+                except (TypeError, ValueError):
+                    retry_after = 1
+
+                if (body or {}).get("global", False) or headers.get(
+                    "X-RateLimit-Global"
+                ):
+                    self.global_until = max(self.global_until, now + retry_after)
+                else:
+                    self.buckets[bucket_id] = (0, now + retry_after)
+
+        return retry_after
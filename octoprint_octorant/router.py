@@ -0,0 +1,180 @@
+# coding: utf-8
+
+# Sends the messages to the webhooks their event is routed to.
+#
+# Every webhook has its own sender (thread, HTTP session, queue, rate limits and outbox),
+# so a rate limited channel doesn't hold the messages of the other ones. The media of a
+# message is captured once, and shared by all its destinations.
+
+import logging
+import os
+import re
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from .config import Config
+from . import discord_async
+from .discord import DiscordMessage, SharedMedia
+from .discord_async import AsyncDiscordMessage
+from .media import Media
+from .outqueue import DEFAULT_PRIORITY
+from .tracing import Trace
+
+# The webhook set up in the settings page, used by the events without "webhooks"
+DEFAULT_WEBHOOK = "default"
+
+reUnsafeFileName = re.compile(r"[^A-Za-z0-9_-]")
+
+
+class Router:
+    def __init__(self, logger: logging.Logger, engine="thread"):
+        self._logger = logger
+
+        # "thread" for a thread per webhook, "asyncio" for a shared event loop
+        self.engine = engine
+        if engine == "asyncio" and not discord_async.available():
+            self._logger.warning("httpx is not installed, using the threaded sender")
+            self.engine = "thread"
+
+        self.config: Config = None
+
+        # webhook name -> sender
+        self.senders = {}
+
+        # Outbox settings, the database of each webhook is in this folder
+        self.outbox_folder = None
+        self.outbox_options = ()
+
+        self.media_workers = 0
+        self.media_pool: ThreadPoolExecutor = None
+
+        # Timelapses being transcoded take minutes, they don't hold the media workers
+        self.transcode_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="octorant-transcode"
+        )
+
+    def apply_config(self, config: Config):
+        self.config = config
+        self.set_media_config(config.media_workers)
+
+        for name in [name for name in self.senders if name not in config.webhooks]:
+            self._logger.debug("Webhook {} removed".format(name))
+            self.senders.pop(name).stop()
+
+        for name, webhook in config.webhooks.items():
+            sender = self.senders.get(name)
+            if sender is None:
+                sender = self.create_sender(name)
+                self.senders[name] = sender
+                self.configure_outbox(name)
+
+            sender.apply_config(config, webhook)
+
+    def create_sender(self, name) -> DiscordMessage:
+        if self.engine == "asyncio":
+            return AsyncDiscordMessage(self._logger, name=name)
+
+        return DiscordMessage(self._logger, name=name)
+
+    def set_media_config(self, workers=2):
+        if workers == self.media_workers:
+            return
+
+        # Already submitted captures will end on the old pool
+        old_pool = self.media_pool
+        self.media_workers = workers
+        self.media_pool = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="octorant-media"
+        )
+        if old_pool is not None:
+            old_pool.shutdown(wait=False)
+
+    def set_outbox(self, folder, base_delay=5, max_delay=900, max_attempts=10):
+        self.outbox_folder = folder
+        self.outbox_options = (base_delay, max_delay, max_attempts)
+
+        for name in self.senders:
+            self.configure_outbox(name)
+
+    def configure_outbox(self, name):
+        if self.outbox_folder is None:
+            self.senders[name].set_outbox(None, *self.outbox_options)
+            return
+
+        fileName = "outbox.db"
+        if name != DEFAULT_WEBHOOK:
+            fileName = "outbox-{}.db".format(reUnsafeFileName.sub("_", name))
+
+        self.senders[name].set_outbox(
+            os.path.join(self.outbox_folder, fileName), *self.outbox_options
+        )
+
+    def destinations(self, event_id):
+        if self.config is None:
+            return []
+
+        if event_id == "test":
+            # The test message checks every webhook
+            names = list(self.config.webhooks)
+        else:
+            event = self.config.events.get(event_id) or {}
+            names = event.get("webhooks") or [DEFAULT_WEBHOOK]
+
+        return [
+            self.senders[name]
+            for name in names
+            if name in self.senders and "http" in self.senders[name].url
+        ]
+
+    def send_message(
+        self,
+        content: str,
+        media: Media = None,
+        event_id="",
+        job="",
+        priority=DEFAULT_PRIORITY,
+        trace: Trace = None,
+        before: Future = None,
+        after=None,
+    ) -> bool:
+        # after is called once the media is captured, or once the before script is
+        # done without media.
+        senders = self.destinations(event_id)
+        if len(senders) == 0:
+            return False
+
+        # Start grabbing the media right away, only once for all the destinations
+        shared_media = None
+        if media is not None and content != "":
+            pool = self.transcode_pool if media.timeout > 0 else self.media_pool
+            shared_media = SharedMedia(
+                pool.submit(get_media, media, trace, before),
+                len(senders),
+                before,
+            )
+
+        for sender in senders:
+            sender.send_message(
+                content, media, shared_media, event_id, job, priority, trace
+            )
+
+        if after is not None:
+            if shared_media is not None:
+                shared_media.future.add_done_callback(lambda _: after())
+            elif before is not None:
+                before.add_done_callback(lambda _: after())
+            else:
+                after()
+
+        return True
+
+
+def get_media(media: Media, trace: Trace = None, before: Future = None):
+    if before is not None:
+        # e.g. a script turning the lights on for the snapshot
+        before.result()
+
+    if trace is None or media.type is None:
+        return media.get()
+
+    with trace.span("media", type=media.type):
+        return media.get()
@@ -12,12 +12,47 @@ $(function() {
         self.events = null;
         self.progress = null;
 
+        // Timing of the latest notifications
+        self.traces = ko.observableArray([]);
+        self.tracesLoading = ko.observable(false);
+
         self.onBeforeBinding = () => {
             self.events = self.settings.settings.plugins.octorant.events;
             self.progress = self.settings.settings.plugins.octorant.progress;
 
             console.log(self);
         }
+
+        self.onSettingsShown = () => {
+            self.loadTraces();
+        }
+
+        self.loadTraces = () => {
+            self.tracesLoading(true);
+            OctoPrint.get(OctoPrint.getBlueprintUrl("octorant") + "traces")
+                .done((response) => {
+                    self.traces(response.traces);
+                })
+                .always(() => {
+                    self.tracesLoading(false);
+                });
+        }
+
+        self.formatTraceTime = (trace) => {
+            return new Date(trace.started * 1000).toLocaleString();
+        }
+
+        self.formatDuration = (seconds) => {
+            return (seconds * 1000).toFixed(0) + " ms";
+        }
+
+        self.formatOutcomes = (trace) => {
+            return Object.keys(trace.outcomes).map((webhook) => webhook + ": " + trace.outcomes[webhook]).join(", ");
+        }
+
+        self.formatSpan = (span) => {
+            return span.name + (span.webhook ? " (" + span.webhook + ")" : "") + ": " + self.formatDuration(span.duration);
+        }
     }
 
     // view model class, parameters for constructor, container to bind to
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+# Timing of every notification, from the OctoPrint event to the answer of Discord.
+#
+# Each OctoPrint event gets a correlation id, shared by the notifications it triggers.
+# The time spent in every stage (scripts, template, media, queue, request to Discord) is
+# recorded as a span, for each webhook the message is sent to. Once every message of
+# the notification is sent (or given up), its trace is kept in a ring buffer, shown on
+# the settings page, and optionally appended to a JSON-lines file.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+from collections import deque
+from contextlib import contextmanager
+
+# The export file is rotated once above this size
+EXPORT_MAX_SIZE = 5 * 1024 * 1024
+
+
+class Trace:
+    def __init__(self, tracer, trace_id, source, event_id, started=None) -> None:
+        self.tracer = tracer
+        self.id = trace_id
+
+        # OctoPrint event, and notification of the plugin
+        self.source = source
+        self.event_id = event_id
+
+        self.started = time.time()
+        self.origin = time.monotonic() if started is None else started
+        self.lock = threading.Lock()
+
+        # (name, start since origin, duration, attributes)
+        self.spans = []
+
+        # Webhook -> what happened to its message
+        self.outcomes = {}
+
+        # The notification itself, and each of its messages until they are done
+        self.pending = 1
+        self.finished = False
+
+    def add(self, name, started, duration, **attributes):
+        with self.lock:
+            self.spans.append((name, started - self.origin, duration, attributes))
+
+    @contextmanager
+    def span(self, name, **attributes):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.monotonic() - started, **attributes)
+
+    def hold(self):
+        with self.lock:
+            self.pending += 1
+
+    def release(self, webhook=None, outcome=None):
+        with self.lock:
+            if webhook is not None:
+                self.outcomes[webhook] = outcome
+
+            self.pending -= 1
+            if self.pending > 0 or self.finished:
+                return
+
+            self.finished = True
+            self.duration = time.monotonic() - self.origin
+
+        self.tracer.record(self)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "source": self.source,
+                "event": self.event_id,
+                "started": self.started,
+                "duration": round(self.duration, 4),
+                "outcomes": dict(self.outcomes),
+                "spans": [
+                    dict(
+                        attributes,
+                        name=name,
+                        start=round(start, 4),
+                        duration=round(duration, 4),
+                    )
+                    for name, start, duration, attributes in sorted(
+                        self.spans, key=lambda s: s[1]
+                    )
+                ],
+            }
+
+
+class Tracer:
+    def __init__(self, logger, size=50) -> None:
+        self._logger = logger
+
+        self.lock = threading.Lock()
+        self.traces = deque(maxlen=max(1, size))
+        self.export_path = None
+
+        # Correlation id and start of the OctoPrint event handled by the thread
+        self.context = threading.local()
+
+    def set_config(self, size=50, export_path=None):
+        with self.lock:
+            if max(1, size) != self.traces.maxlen:
+                self.traces = deque(self.traces, maxlen=max(1, size))
+            self.export_path = export_path
+
+    @contextmanager
+    def event(self, source, started=None):
+        # The notifications sent while handling the event share its correlation id
+        if started is None:
+            started = time.monotonic()
+
+        self.context.current = (uuid.uuid4().hex[:12], source, started)
+        try:
+            yield
+        finally:
+            self.context.current = None
+
+    def start(self, event_id) -> Trace:
+        current = getattr(self.context, "current", None)
+        if current is None:
+            # e.g. progress timers, not started by an OctoPrint event
+            return Trace(self, uuid.uuid4().hex[:12], None, event_id)
+
+        trace_id, source, started = current
+        return Trace(self, trace_id, source, event_id, started)
+
+    def record(self, trace: Trace):
+        data = trace.to_dict()
+
+        with self.lock:
+            self.traces.append(data)
+            export_path = self.export_path
+
+        if export_path is not None:
+            self.export(export_path, data)
+
+    def export(self, path, data):
+        try:
+            with self.lock:
+                if os.path.exists(path) and os.path.getsize(path) > EXPORT_MAX_SIZE:
+                    os.replace(path, path + ".1")
+
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(data) + "\n")
+        except OSError as error:
+            self._logger.warning("Unable to export trace: {}".format(error))
+
+    def recent(self):
+        # Latest first
+        with self.lock:
+            return list(reversed(self.traces))
@@ -0,0 +1,289 @@
+# coding: utf-8
+
+# Shrinks the timelapses that are bigger than the upload limit of Discord.
+#
+# The movie is transcoded by ffmpeg (the one configured in OctoPrint for the timelapses)
+# at the bitrate that makes it fit in the limit. When that bitrate would be too low to
+# show anything, only the end of the print is kept, or a small GIF is made instead.
+#
+# ffmpeg runs with the lowest CPU priority, in a worker of its own, so that it doesn't
+# disturb the printer or hold the snapshots of the other messages. The result is kept in
+# the data folder of the plugin, and reused as long as the original doesn't change. The
+# copies of deleted timelapses are removed, and the least recently used ones once the
+# folder is above MAX_CACHE_BYTES.
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from threading import Lock
+
+# Part of the limit kept for the container, as the bitrate of the encoder is only a target
+SIZE_MARGIN = 0.9
+
+# Width of the GIF, reduced until it fits
+GIF_WIDTHS = [480, 320, 240]
+GIF_FPS = 10
+
+# Output file extension -> extension of the copies, added to the name of the original
+CACHE_SUFFIXES = {"mp4": ".octorant-mp4", "gif": ".octorant-gif"}
+
+# The most recent copy is always kept, even when it is bigger
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+reDuration = re.compile(rb"Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)")
+
+# One ffmpeg at a time is enough for a Raspberry Pi
+transcodeLock = Lock()
+
+
+def transcode_timelapse(
+    filePath,
+    maxSize,
+    logger,
+    ffmpeg="",
+    timeout=600,
+    minBitrate=200000,
+    fallback="clip",
+    cacheFolder=None,
+):
+    # Returns (file name to upload, path of the file to send), or None.
+    # The copies are kept in cacheFolder, or next to the original without one.
+    if cacheFolder is None:
+        cacheFolder = os.path.dirname(filePath)
+
+    cached = cached_transcode(filePath, maxSize, cacheFolder)
+    if cached is not None:
+        return cached
+
+    if not ffmpeg:
+        ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        logger.warning("ffmpeg not found, the timelapse can't be made smaller")
+        return None
+
+    with transcodeLock:
+        # Maybe done while waiting for the lock
+        cached = cached_transcode(filePath, maxSize, cacheFolder)
+        if cached is not None:
+            return cached
+
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+
+        try:
+            os.makedirs(cacheFolder, exist_ok=True)
+            result = run_transcode(
+                filePath,
+                maxSize,
+                logger,
+                ffmpeg,
+                deadline,
+                minBitrate,
+                fallback,
+                cacheFolder,
+            )
+        except (OSError, subprocess.SubprocessError):
+            logger.error("Timelapse transcoding failed: {}".format(sys.exc_info()[1]))
+            result = None
+
+        for extension in CACHE_SUFFIXES:
+            remove_quietly(cache_path(filePath, cacheFolder, extension) + ".tmp")
+
+        if result is not None:
+            logger.info(
+                "Timelapse reduced from {} to {} bytes in {:.1f}s".format(
+                    os.stat(filePath).st_size,
+                    os.stat(result[1]).st_size,
+                    time.monotonic() - started,
+                )
+            )
+            prune_cache(cacheFolder, os.path.dirname(filePath), result[1], logger)
+
+        return result
+
+
+def cache_path(filePath, cacheFolder, extension):
+    return os.path.join(
+        cacheFolder, os.path.basename(filePath) + CACHE_SUFFIXES[extension]
+    )
+
+
+def cached_transcode(filePath, maxSize, cacheFolder):
+    try:
+        original = os.stat(filePath)
+    except OSError:
+        return None
+
+    for extension in CACHE_SUFFIXES:
+        path = cache_path(filePath, cacheFolder, extension)
+        try:
+            cached = os.stat(path)
+        except OSError:
+            continue
+
+        if cached.st_mtime >= original.st_mtime and 0 < cached.st_size <= maxSize:
+            # Recently used, kept when the folder is pruned
+            os.utime(path)
+            return (upload_name(filePath, extension), path)
+
+    return None
+
+
+def prune_cache(cacheFolder, sourceFolder, keep, logger):
+    copies = []
+    for name in os.listdir(cacheFolder):
+        path = os.path.join(cacheFolder, name)
+        suffix = next((s for s in CACHE_SUFFIXES.values() if name.endswith(s)), None)
+        if suffix is None or path == keep:
+            continue
+
+        # The timelapse has been deleted in OctoPrint
+        if not os.path.exists(os.path.join(sourceFolder, name[: -len(suffix)])):
+            logger.debug("Removing the copy of a deleted timelapse: {}".format(name))
+            remove_quietly(path)
+            continue
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        copies.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in copies) + os.stat(keep).st_size
+
+    # Least recently used first
+    for _, size, path in sorted(copies):
+        if total <= MAX_CACHE_BYTES:
+            break
+
+        remove_quietly(path)
+        total -= size
+
+
+def run_transcode(
+    filePath, maxSize, logger, ffmpeg, deadline, minBitrate, fallback, cacheFolder
+):
+    duration = probe_duration(filePath, ffmpeg, deadline)
+    if duration is None or duration <= 0:
+        logger.warning("Unable to get the duration of {}".format(filePath))
+        return None
+
+    budget = maxSize * 8 * SIZE_MARGIN
+    bitrate = int(budget / duration)
+
+    if bitrate < minBitrate and fallback == "gif":
+        return encode_gif(filePath, maxSize, logger, ffmpeg, deadline, cacheFolder)
+
+    clip = 0
+    if bitrate < minBitrate:
+        # Only the end of the print, at the lowest acceptable bitrate
+        clip = budget / minBitrate
+        bitrate = minBitrate
+        logger.debug("Timelapse too long, keeping its last {:.0f}s".format(clip))
+
+    output = cache_path(filePath, cacheFolder, "mp4")
+
+    # The bitrate is a target: try again lower if the encoder went above it
+    for _ in range(2):
+        logger.debug("Transcoding timelapse at {} bit/s".format(bitrate))
+        run_ffmpeg(
+            [ffmpeg]
+            + (["-sseof", "-{:.2f}".format(clip)] if clip > 0 else [])
+            + ["-i", filePath, "-an", "-c:v", "libx264", "-preset", "veryfast"]
+            + ["-b:v", str(bitrate), "-maxrate", str(bitrate)]
+            + ["-bufsize", str(bitrate * 2), "-pix_fmt", "yuv420p"]
+            + ["-movflags", "+faststart", "-f", "mp4", output + ".tmp"],
+            deadline,
+        )
+
+        size = os.stat(output + ".tmp").st_size
+        if size <= maxSize:
+            os.replace(output + ".tmp", output)
+            return (upload_name(filePath, "mp4"), output)
+
+        bitrate = int(bitrate * maxSize * SIZE_MARGIN / size)
+
+    logger.warning("Unable to make the timelapse fit in {} bytes".format(maxSize))
+    return None
+
+
+def encode_gif(filePath, maxSize, logger, ffmpeg, deadline, cacheFolder):
+    output = cache_path(filePath, cacheFolder, "gif")
+
+    for width in GIF_WIDTHS:
+        logger.debug("Converting timelapse to a {}px GIF".format(width))
+        run_ffmpeg(
+            [ffmpeg, "-i", filePath, "-an", "-filter_complex"]
+            + [
+                "fps={},scale={}:-2:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse".format(
+                    GIF_FPS, width
+                )
+            ]
+            + ["-f", "gif", output + ".tmp"],
+            deadline,
+        )
+
+        if os.stat(output + ".tmp").st_size <= maxSize:
+            os.replace(output + ".tmp", output)
+            return (upload_name(filePath, "gif"), output)
+
+    logger.warning("Unable to make a GIF smaller than {} bytes".format(maxSize))
+    return None
+
+
+def probe_duration(filePath, ffmpeg, deadline):
+    # ffmpeg exits with an error without an output file, but still prints the duration
+    result = subprocess.run(
+        low_priority([ffmpeg, "-hide_banner", "-i", filePath]),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=max(1, deadline - time.monotonic()),
+    )
+
+    match = reDuration.search(result.stderr)
+    if match is None:
+        return None
+
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def run_ffmpeg(args, deadline):
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise subprocess.TimeoutExpired(args, 0)
+
+    subprocess.run(
+        low_priority(
+            args[:1] + ["-y", "-hide_banner", "-loglevel", "error"] + args[1:]
+        ),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=remaining,
+        check=True,
+    )
+
+
+def low_priority(command):
+    # Runs the command with the lowest CPU priority, through nice when there is one.
+    # (preexec_fn is not safe in a process running other threads)
+    nice = shutil.which("nice")
+    if nice is None:
+        return command
+
+    return [nice, "-n", "19"] + command
+
+
+def upload_name(filePath, extension):
+    return os.path.splitext(os.path.basename(filePath))[0] + "." + extension
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass